@@ -0,0 +1,109 @@
+import sys
+import json
+import time
+import zlib
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import pongofour as pf
+import emufour as ef
+
+# Runs a ROM lots of times over in parallel, headless, with different seeds and/or recorded input
+# (from emufour --record), and reports what each run ended up with:
+#   python batchfour.py pfpong.bin --seeds 1-1000 --frames 600
+#   python batchfour.py pfpong.bin --inputs logs/*.log --frames 600 --out results.jsonl
+# Every job gets a fresh core and fresh devices, and runs the same frame loop emufour --headless does.
+# The ROM itself reaches the workers through shared memory, once per worker.
+
+worker_rom = None
+
+# Workers share the pool's resource tracker, so attaching here doesn't need the dance SharedFrame does.
+def init_worker(rom_name, rom_size):
+    global worker_rom
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(rom_name)
+    try:
+        worker_rom = bytes(shm.buf[:rom_size])
+    finally:
+        shm.close()
+
+# One run. Returns a dict of everything worth comparing between runs.
+def run_job(job):
+    name, seed, recorded, frames, instructions = job
+    ef.reset_devices(seed)
+    core = pf.PongoCore(worker_rom, ef.build_bus())
+    log = ef.InputLog(seed, recorded) if recorded is not None else None
+
+    # Every frame goes into a running CRC, so two runs only match if all their frames did.
+    frames_crc = 0
+    def add_frame():
+        nonlocal frames_crc
+        frames_crc = zlib.crc32(ef.display.vram, frames_crc)
+
+    begin_time = time.perf_counter()
+    frame_count = ef.run_frames(core, frames, instructions, replay=log, on_frame=add_frame)
+
+    return {
+        "job": name, "seed": seed, "frames": frame_count, "cycles": core.cycles,
+        "frames_crc": f"{frames_crc:08x}",
+        "framebuffer": hashlib.sha1(ef.display.vram).hexdigest(),
+        "ram": hashlib.sha1(core.ram_view).hexdigest(),
+        "diverged": log.diverged if log is not None else None,
+        "seconds": round(time.perf_counter() - begin_time, 4),
+    }
+
+# "1-100,200,300-310" -> 1, 2, ... 100, 200, 300, ... 310
+def parse_seeds(text):
+    seeds = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        seeds.extend(range(int(first, 0), int(last or first, 0) + 1))
+    return seeds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pongo v4 batch runner")
+    parser.add_argument("rom", help="binary to run (from impede)")
+    parser.add_argument("--seeds", help="seeds to run with, like 1-100,200")
+    parser.add_argument("--inputs", nargs="*", default=[], help="input logs from emufour --record (with --seeds, each log runs with each seed)")
+    parser.add_argument("--frames", type=int, required=True, help="frames per run")
+    parser.add_argument("--instructions", type=int, default=100000000, help="give up on a run after this many instructions (default: 100M)")
+    parser.add_argument("--workers", type=int, help="processes to use (default: one per CPU)")
+    parser.add_argument("--out", help="write a JSON line per run here (default: stdout)")
+    args = parser.parse_args()
+
+    seeds = parse_seeds(args.seeds) if args.seeds else None
+    if seeds is None and not args.inputs: parser.error("need --seeds or --inputs")
+
+    jobs = []
+    if not args.inputs:
+        jobs = [(f"seed {seed}", seed, None, args.frames, args.instructions) for seed in seeds]
+    for path in args.inputs:
+        log = ef.InputLog.load(path)
+        for seed in seeds or [log.seed]:
+            jobs.append((f"{path} seed {seed}", seed, log.frames, args.frames, args.instructions))
+
+    from multiprocessing import shared_memory
+    rom = bytes(ef.load_rom(args.rom))
+    shm = shared_memory.SharedMemory(create=True, size=max(len(rom), 1))
+    shm.buf[:len(rom)] = rom
+
+    outfile = open(args.out, "w") if args.out else sys.stdout
+    framebuffers = set()
+    diverged = 0
+    begin_time = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(shm.name, len(rom))) as pool:
+            for result in pool.map(run_job, jobs, chunksize=max(1, len(jobs) // 256)):
+                outfile.write(json.dumps(result) + "\n")
+                framebuffers.add(result["framebuffer"])
+                if result["diverged"] is not None: diverged += 1
+    finally:
+        if outfile is not sys.stdout: outfile.close()
+        shm.close()
+        shm.unlink()
+
+    total_time = time.perf_counter() - begin_time
+    print(f"Ran {len(jobs)} jobs in {total_time:.2f}s ({len(jobs) / total_time:.1f} jobs/sec), "
+          f"{len(framebuffers)} different final frames, {diverged} diverged from their logs", file=sys.stderr)
@@ -0,0 +1,62 @@
+import sys
+import time
+
+import pongofour as pf
+
+# Micro-benchmarks for the core. Run with a ROM that starts with a memcpy (like pfpong.bin):
+#   python benchfour.py pfpong.bin
+
+# The old way of doing Flow writes, bit by bit. Kept here so there's something to compare against.
+class ChainedFlowCore(pf.PongoCore):
+    def write_registers(self, addr, data):
+        self.ram[addr] = data
+
+        if addr == pf.Regs.Flow:
+            if (data & pf.FlowLines.SixteenWide): self.next_sixteen = True
+            if (data & pf.FlowLines.InhibitIfZero): self.next_inhibit = True
+            if (data & pf.FlowLines.LoadIndirect): self.next_load_indirect = True
+            if (data & pf.FlowLines.StoreIndirect): self.next_store_indirect = True
+
+            if (data & pf.FlowLines.LoopDown): self.counter_down(pf.Regs.LoopLo)
+            if (data & pf.FlowLines.IndirectUp): self.counter_up(pf.Regs.IndiLo)
+            if (data & pf.FlowLines.IndirectDown): self.counter_down(pf.Regs.IndiLo)
+
+
+# Time a function, best of a few runs.
+def best_of(runs, func):
+    best = None
+    for r in range(runs):
+        begin = time.perf_counter()
+        func()
+        took = time.perf_counter() - begin
+        if best is None or took < best: best = took
+    return best
+
+# Step the interpreter through the first chunk of the ROM - for pfpong.bin, that's the splash memcpy.
+def bench_spin(core_type, rom, count):
+    def go():
+        core = core_type(rom, lambda addr, data=None: 0)
+        for i in range(count): core.spin()
+    return best_of(5, go)
+
+# Just the Flow writes from a memcpy loop body, without anything else in the way.
+def bench_flow(core_type, rom, count):
+    core = core_type(rom, lambda addr, data=None: 0)
+    pattern = [pf.FlowLines.SixteenWide, pf.FlowLines.LoadIndirect, pf.FlowLines.IndirectUp, pf.FlowLines.SixteenWide,
+               pf.FlowLines.SixteenWide, pf.FlowLines.StoreIndirect, pf.FlowLines.IndirectUp, pf.FlowLines.SixteenWide,
+               pf.FlowLines.LoopDown, pf.FlowLines.InhibitIfZero | pf.FlowLines.SixteenWide]
+    def go():
+        for i in range(count // len(pattern)):
+            for p in pattern: core.set(pf.Regs.Flow, p)
+    return best_of(5, go)
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], "rb") as binfile:
+        rom = binfile.read()[0x8000:]
+
+    count = 100000
+    for name, bench in (("memcpy body, spin()", bench_spin), ("flow writes only", bench_flow)):
+        chained = bench(ChainedFlowCore, rom, count)
+        table = bench(pf.PongoCore, rom, count)
+        print(f"{name}: chained {count / chained / 1000:.0f}k/s, table {count / table / 1000:.0f}k/s ({chained / table:.2f}x)")
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import stat
+import queue
+import argparse
+import threading
+import socketserver
+
+import pongofour as pf
+
+# A small debug protocol for poking at a running core from outside. Clients connect over TCP (localhost
+# only) or a Unix socket and send one JSON line per batch: a list of commands like
+#   [{"cmd": "pause"}, {"cmd": "step", "count": 1000}, {"cmd": "regs"}]
+# and get back one JSON line with a result for each. A batch runs in one go between frames, so a
+# thousand steps cost one round trip. The first command to fail ends the batch.
+#
+# The emulator has to call service() now and then (once a frame is plenty) for anything to happen.
+# From the shell:
+#   python debugfour.py 6502 pause "step 1000" regs "read 0x4000 32"
+
+class DebugServer():
+    def __init__(self, address):
+        self.jobs = queue.Queue()
+        self.paused = False
+        self.hit = None
+        self.snapshots = {}
+
+        debugger = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip(): continue
+                    try:
+                        batch = json.loads(line)
+                        if isinstance(batch, dict): batch = [batch]
+                        if not isinstance(batch, list) or not all(isinstance(command, dict) for command in batch):
+                            raise ValueError("a batch is a list of commands like {\"cmd\": \"regs\"}")
+                        results = debugger.submit(batch)
+                    except ValueError as e:
+                        results = [{"error": str(e)}]
+                    self.wfile.write(json.dumps(results).encode() + b"\n")
+
+        # A bare number is a TCP port, anything else is a path for a Unix socket.
+        self.address = address
+        if str(address).isdigit():
+            self.server = socketserver.ThreadingTCPServer(("127.0.0.1", int(address)), Handler)
+        else:
+            # Clear out the socket from a run that didn't get to clean up after itself.
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode): os.unlink(address)
+            self.server = socketserver.ThreadingUnixStreamServer(address, Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="debugger", daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if not str(self.address).isdigit():
+            try: os.unlink(self.address)
+            except OSError: pass
+
+    # Client side of the queue: hand a batch to the emulator and wait for it to come back.
+    def submit(self, batch):
+        reply = queue.Queue(1)
+        self.jobs.put((batch, reply))
+        try:
+            return reply.get(timeout=60)
+        except queue.Empty:
+            return [{"error": "emulator isn't responding"}]
+
+    # Emulator side: run whatever batches are waiting. With wait, sleeps until at least one arrives
+    # (or a moment passes), which is what a paused emulator should be doing anyway.
+    def service(self, core, wait=False):
+        while True:
+            try:
+                batch, reply = self.jobs.get(timeout=0.05) if wait else self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            wait = False
+
+            results = []
+            for command in batch:
+                try:
+                    handler = getattr(self, "cmd_" + command["cmd"], None)
+                    if handler is None: raise ValueError(f"no such command {command['cmd']}")
+                    results.append(handler(core, command))
+                except Exception as e:
+                    results.append({"error": f"{type(e).__name__}: {e}"})
+                    break
+            reply.put(results)
+
+    # The emulator ran into a breakpoint on its own.
+    def stopped(self, hit):
+        self.hit = hit
+        self.paused = True
+
+    # Commands. Each takes the core and the command dict, and returns something JSON can carry.
+    def cmd_status(self, core, command):
+        return {"paused": self.paused, "cycles": core.cycles, "hit": self.hit}
+
+    def cmd_pause(self, core, command):
+        self.paused = True
+        return self.cmd_status(core, command)
+
+    def cmd_resume(self, core, command):
+        self.paused = False
+        self.hit = None
+        return self.cmd_status(core, command)
+
+    # Reports only what this step ran into. run_until forgets the last hit itself, apart from letting go
+    # of a breakpoint we're still sitting on.
+    def cmd_step(self, core, command):
+        self.hit = None
+        core.run_until(core.cycles + int(command.get("count", 1)))
+        self.hit = core.hit
+        return {"cycles": core.cycles, "hit": core.hit}
+
+    def cmd_regs(self, core, command):
+        names = core.debug_names()
+        del names["ram"]
+        names["flow"] = core.ram[pf.Regs.Flow]
+        names["flags"] = core.flow_state()
+        return names
+
+    # Takes any of ip, loop, indi, a, d, pushes and flags (packed like flow_state()). The low six bits of
+    # A are always clear on real hardware, and the core counts on it, so they're dropped.
+    def cmd_set(self, core, command):
+        value = int(command["value"])
+        reg = command["reg"]
+        if reg in ("ip", "loop", "indi"):
+            base = {"ip": pf.Regs.IpLo, "loop": pf.Regs.LoopLo, "indi": pf.Regs.IndiLo}[reg]
+            core.ram[base] = value & 0xFF
+            core.ram[base + 1] = (value >> 8) & 0xFF
+        elif reg == "a": core.a = value & 0xFFC0
+        elif reg == "d": core.d = value & 0xFFFF
+        elif reg == "pushes": core.num_pushes = value
+        elif reg == "flags":
+            core.next_sixteen = bool(value & 1)
+            core.next_inhibit = bool(value & 2)
+            core.next_load_indirect = bool(value & 4)
+            core.next_store_indirect = bool(value & 8)
+        else:
+            raise ValueError(f"no such register {reg}")
+        return self.cmd_regs(core, command)
+
+    # RAM and ROM are read as-is. The I/O window is peeked at, so reading it doesn't disturb the devices
+    # (the RNG doesn't move on, for one).
+    def cmd_read(self, core, command):
+        addr = int(command["addr"]) & 0xFFFF
+        length = min(int(command.get("length", 1)), 0x10000 - addr)
+        if addr + length <= 0x4000 or addr >= 0x8000:
+            data = bytes(core.memory[addr:addr + length])
+        else:
+            data = bytes(core.peek(addr + i) for i in range(length))
+        return {"addr": addr, "data": data.hex()}
+
+    def cmd_write(self, core, command):
+        addr = int(command["addr"]) & 0xFFFF
+        data = bytes.fromhex(command["data"])
+        for i in range(len(data)): core.set(addr + i, data[i])
+        return {"addr": addr, "length": len(data)}
+
+    def cmd_break(self, core, command):
+        core.add_breakpoint(int(command["addr"]), command.get("cond") or None)
+        return self.cmd_points(core, command)
+
+    def cmd_unbreak(self, core, command):
+        core.remove_breakpoint(int(command["addr"]))
+        return self.cmd_points(core, command)
+
+    # Mode is some mix of r and w, default w.
+    def cmd_watch(self, core, command):
+        mode = command.get("mode", "w")
+        core.add_watchpoint(int(command["addr"]), read="r" in mode, write="w" in mode)
+        return self.cmd_points(core, command)
+
+    def cmd_unwatch(self, core, command):
+        core.remove_watchpoint(int(command["addr"]))
+        return self.cmd_points(core, command)
+
+    def cmd_points(self, core, command):
+        return {"breakpoints": sorted(core.breakpoints), "reads": sorted(core.read_watches), "writes": sorted(core.write_watches)}
+
+    # Snapshots are kept in the server by name. The first one is taken in full and the rest are deltas from it.
+    def cmd_snapshot(self, core, command):
+        base = next(iter(self.snapshots.values()), None)
+        self.snapshots[command.get("name", "")] = core.snapshot(base)
+        return {"snapshots": list(self.snapshots)}
+
+    def cmd_restore(self, core, command):
+        core.restore(self.snapshots[command.get("name", "")])
+        return self.cmd_regs(core, command)
+
+    # And to and from files, for passing around.
+    def cmd_save(self, core, command):
+        core.snapshot().save(command["path"])
+        return {"path": command["path"]}
+
+    def cmd_load(self, core, command):
+        core.restore(pf.Snapshot.load(command["path"]))
+        return self.cmd_regs(core, command)
+
+
+# The other end. Connects to a DebugServer and sends batches.
+class DebugClient():
+    def __init__(self, address):
+        import socket
+        if str(address).isdigit():
+            self.socket = socket.create_connection(("127.0.0.1", int(address)))
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+        self.file = self.socket.makefile("rwb")
+
+    def batch(self, commands):
+        self.file.write(json.dumps(commands).encode() + b"\n")
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def call(self, cmd, **args):
+        return self.batch([dict(args, cmd=cmd)])[0]
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+# How the words of a command typed at the shell map onto its fields. Whatever's left over goes in the last one.
+COMMAND_ARGS = {
+    "step": ("count",), "set": ("reg", "value"), "read": ("addr", "length"), "write": ("addr", "data"),
+    "break": ("addr", "cond"), "unbreak": ("addr",), "watch": ("addr", "mode"), "unwatch": ("addr",),
+    "snapshot": ("name",), "restore": ("name",), "save": ("path",), "load": ("path",),
+}
+
+def parse_command(text):
+    words = text.split()
+    fields = COMMAND_ARGS.get(words[0], ())
+    command = {"cmd": words[0]}
+    for i, field in enumerate(fields):
+        if i + 1 >= len(words): break
+        value = " ".join(words[i + 1:]) if i == len(fields) - 1 else words[i + 1]
+        if field in ("count", "value", "addr", "length"): value = int(value, 0)
+        command[field] = value
+    return command
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pongo v4 debug client")
+    parser.add_argument("address", help="port or socket path the emulator was started with (--debug)")
+    parser.add_argument("commands", nargs="*", help="commands to send as one batch, e.g. \"step 1000\" (none: read them from stdin, a line per batch, ; between commands)")
+    args = parser.parse_args()
+
+    client = DebugClient(args.address)
+    if args.commands:
+        batches = [args.commands]
+    else:
+        batches = ([c for c in line.split(";") if c.strip()] for line in sys.stdin)
+
+    for batch in batches:
+        if not batch: continue
+        for result in client.batch([parse_command(c) for c in batch]):
+            print(json.dumps(result))
+    client.close()
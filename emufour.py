@@ -1,63 +1,173 @@
 import os
+import ast
 import sys
+import zlib
+import time
+import queue
+import struct
 import random
-import json
-
-import pygame
+import signal
+import argparse
+import threading
+import collections
 
 import pongofour as pf
-import asmfour as af
 
 # I/O tweakables.
 display_size = (32, 32)
 zoom = 16
 display_scaled = (display_size[0] * zoom, display_size[1] * zoom)
-waiting_frame = False
-paddle_a = 0
-buttons_a = 0
-paddle_b = 0
-buttons_b = 0
 
-fb = None
+vram_array = None
 sfb = None
+exchange = None
+
+# Frame time counters.
+presents = 0
+presents_skipped = 0
+present_time = 0.0
 
 printing = True
 pausing = True
 spins = 0
-spins_per_frame = 0
-
-def pongo_io(addr, data=None):
-    global waiting_frame
-    global printing
-    global pausing
-
-    if data is None:
-        if addr == 1024:
-            return paddle_a
-        elif addr == 1025:
-            return buttons_a
-        elif addr == 1026:
-            return paddle_b
-        elif addr == 1027:
-            return buttons_b
-        elif addr == 1028:
-            return random.randint(0, 255)
-        else:
-            return 0xEA
 
-    else:
-        # TODO: enums and shiz
-        if addr < 1024:
-            fb.set_at((addr % display_size[0], int(addr / display_size[1])), data)
-        elif addr == 1031:
-            if data & 0x01: waiting_frame = True
-            if data & 0x80: 
-                pausing = True
-                printing = True
-                waiting_frame = True
+# The emulator's hardware, hung off the core's device bus.
+class Display(pf.Device):
+    def __init__(self):
+        # VRAM is a plain bytearray; the window looks at it through numpy when it's time to draw.
+        # Rows that changed since the last draw get flagged, so the window only redraws those.
+        self.vram = bytearray(display_size[0] * display_size[1])
+        self.dirty_rows = bytearray(b"\x01" * display_size[1])
+
+    def write(self, offset, data):
+        if self.vram[offset] != data:
+            self.vram[offset] = data
+            self.dirty_rows[offset // display_size[0]] = 1
+
+    def write_block(self, offset, data):
+        width = display_size[0]
+        end = offset + len(data)
+        for row in range(offset // width, (end - 1) // width + 1):
+            lo = max(offset, row * width)
+            hi = min(end, (row + 1) * width)
+            if self.vram[lo:hi] != data[lo - offset:hi - offset]:
+                self.vram[lo:hi] = data[lo - offset:hi - offset]
+                self.dirty_rows[row] = 1
+
+    def get_state(self):
+        return bytes(self.vram)
+
+    def set_state(self, state):
+        self.write_block(0, state)
+
+class Controllers(pf.Device):
+    def __init__(self):
+        self.paddle_a = 0
+        self.buttons_a = 0
+        self.paddle_b = 0
+        self.buttons_b = 0
+
+    def read(self, offset):
+        return (self.paddle_a, self.buttons_a, self.paddle_b, self.buttons_b)[offset]
+
+    def get_state(self):
+        return (self.paddle_a, self.buttons_a, self.paddle_b, self.buttons_b)
+
+    def set_state(self, state):
+        self.paddle_a, self.buttons_a, self.paddle_b, self.buttons_b = state
+
+# Random numbers come out of a seeded generator a block at a time, so runs can be repeated exactly.
+# The state is just the seed and how many bytes have been handed out.
+class Rng(pf.Device):
+    block_size = 4096
+
+    def __init__(self, seed=None):
+        self.reseed(seed)
+
+    # No seed picks one at random - it's still kept, so the run can be repeated later.
+    def reseed(self, seed=None):
+        if seed is None: seed = int.from_bytes(os.urandom(4), "little")
+        self.seed = seed
+        self.generator = random.Random(seed)
+        self.buffer = b""
+        self.index = 0
+        self.served = 0
+
+    def refill(self):
+        self.buffer = self.generator.randbytes(self.block_size)
+        self.index = 0
+
+    def read(self, offset):
+        if self.index >= len(self.buffer): self.refill()
+        value = self.buffer[self.index]
+        self.index += 1
+        self.served += 1
+        return value
+
+    # The next byte, from a copy of the generator if this block's used up.
+    def peek(self, offset):
+        if self.index < len(self.buffer): return self.buffer[self.index]
+        generator = random.Random()
+        generator.setstate(self.generator.getstate())
+        return generator.randbytes(self.block_size)[0]
+
+    def get_state(self):
+        return (self.seed, self.served)
+
+    def set_state(self, state):
+        seed, served = state
+        self.reseed(seed)
+        while self.served + self.block_size <= served:
+            self.refill()
+            self.served += self.block_size
+        self.refill()
+        self.index = served - self.served
+        self.served = served
+
+class EmuFlow(pf.Device):
+    def __init__(self):
+        self.waiting_frame = False
+        self.pause_requested = False
+
+    def write(self, offset, data):
+        if data & 0x01: self.waiting_frame = True
+        if data & 0x80:
+            self.pause_requested = True
+            self.waiting_frame = True
+
+    def get_state(self):
+        return (self.waiting_frame, self.pause_requested)
+
+    def set_state(self, state):
+        self.waiting_frame, self.pause_requested = state
+
+display = Display()
+controllers = Controllers()
+rng = Rng()
+emuflow = EmuFlow()
+
+# Swap in brand new devices, for starting another run from scratch in the same process. Cores built
+# before this still point at the old ones.
+def reset_devices(seed=None):
+    global display, controllers, rng, emuflow
+    display = Display()
+    controllers = Controllers()
+    rng = Rng(seed)
+    emuflow = EmuFlow()
+
+# Memory map of the emulator's I/O window ($4000 + offset).
+def build_bus():
+    bus = pf.DeviceBus()
+    bus.attach(display, 0, 1024)
+    bus.attach(controllers, 1024, 4)
+    bus.attach(rng, 1028)
+    bus.attach(emuflow, 1031)
+    return bus
 
 
 def print_state(core):
+    # The assembler drags in lark, which is slow to load - only pay for it when printing.
+    import asmfour as af
     global spins
     spins += 1
     this_ip = core.get(pf.Regs.IpHi) << 8 | core.get(pf.Regs.IpLo)
@@ -69,46 +179,756 @@ def print_state(core):
     # if this_ip == 0x800e: breakpoint()
     # if spins > 40: sys.exit(-2)
 
+# The palette, as 768 bytes of RGB. Parsing the JSON is slow, so it's done once and cached where git
+# doesn't look.
+palette_json = "xterm_colors.json"
+palette_cache = os.path.join("__pycache__", "xterm_colors.pal")
+
+def load_palette():
+    try:
+        if os.path.getmtime(palette_cache) >= os.path.getmtime(palette_json):
+            with open(palette_cache, "rb") as cached:
+                raw = cached.read()
+            if len(raw) == 768: return raw
+    except OSError:
+        pass
+
+    import json
+    with open(palette_json, "r") as palette:
+        colo = json.loads(palette.read())
+    raw = bytes(v for c in range(256) for v in (colo[str(c)]["r"], colo[str(c)]["g"], colo[str(c)]["b"]))
+
+    try:
+        os.makedirs(os.path.dirname(palette_cache), exist_ok=True)
+        with open(palette_cache, "wb") as cached:
+            cached.write(raw)
+    except OSError:
+        pass
+    return raw
+
+# Put whatever changed in VRAM on the screen. Runs of dirty rows get a nearest-neighbour upscale in numpy,
+# and only those strips are blitted and updated. If nothing changed, nothing happens.
+def present(screen):
+    global presents
+    global presents_skipped
+    global present_time
+
+    begin_time = time.perf_counter()
+
+    # Hold on to the front buffer just long enough to copy it to the surface.
+    exchange.lock.acquire()
+    dirty_rows = exchange.dirty_rows
+    strips = []
+    y = 0
+    while y < display_size[1]:
+        if dirty_rows[y]:
+            top = y
+            while y < display_size[1] and dirty_rows[y]: y += 1
+            strips.append((top, y))
+        else:
+            y += 1
+
+    if not strips:
+        exchange.lock.release()
+        presents_skipped += 1
+        return
+
+    dirty_rows[:] = bytes(display_size[1])
+
+    # VRAM is row-major (y, x) but surfarray wants (x, y).
+    pixels = pygame.surfarray.pixels2d(sfb)
+    for top, bottom in strips:
+        pixels[:, top * zoom:bottom * zoom] = vram_array[top:bottom].T.repeat(zoom, 0).repeat(zoom, 1)
+    del pixels  # unlocks the surface
+    exchange.lock.release()
+
+    rects = []
+    for top, bottom in strips:
+        rect = pygame.Rect(0, top * zoom, display_scaled[0], (bottom - top) * zoom)
+        screen.blit(sfb, rect, rect)
+        rects.append(rect)
+    pygame.display.update(rects)
+
+    presents += 1
+    present_time += time.perf_counter() - begin_time
+
+def print_frame_stats():
+    frames = presents + presents_skipped
+    if frames == 0: return
+    print(f"Drew {presents} frames, skipped {presents_skipped} unchanged")
+    print(f"...{present_time / frames * 1000:.3f}ms host time per frame ({present_time / max(presents, 1) * 1000:.3f}ms per drawn frame)")
+
+# Decides how many instructions to run each host frame, and sleeps off whatever's left of it.
+# With a fixed clock rate the budget never changes and slow hosts drop frames. Otherwise the
+# budget follows measured throughput so running takes about `headroom` of each frame.
+# Turbo mode never sleeps.
+class FramePacer():
+    headroom = 0.8
+    min_budget = 1000
+
+    def __init__(self, fps=75, clock_hz=None, turbo=False):
+        self.period = 1000000000 // fps
+        self.clock_hz = clock_hz
+        self.turbo = turbo
+        self.budget = clock_hz // fps if clock_hz else self.min_budget
+        self.ns_per_cycle = None
+
+        self.frames = 0
+        self.dropped = 0
+        self.jitter_total = 0
+        self.jitter_max = 0
+        self.last_frame = time.perf_counter_ns()
+        self.deadline = self.last_frame + self.period
+
+    # Tell the pacer how long it took to run some instructions.
+    def ran(self, cycles, ns):
+        # Too few to time properly.
+        if cycles < 100: return
+
+        rate = ns / cycles
+        if self.ns_per_cycle is None: self.ns_per_cycle = rate
+        else: self.ns_per_cycle += (rate - self.ns_per_cycle) / 8
+
+        if self.clock_hz is None:
+            # Fast-forwarded loops can make a frame look very cheap, so don't grow more than 2x at a time.
+            fit = int(self.period * self.headroom / self.ns_per_cycle)
+            self.budget = max(self.min_budget, min(fit, self.budget * 2))
+
+    # End of a host frame: sleep until the next one's due and keep count of how it went.
+    def wait(self):
+        now = time.perf_counter_ns()
+        if not self.turbo and now < self.deadline:
+            time.sleep((self.deadline - now) / 1e9)
+            now = time.perf_counter_ns()
+
+        self.frames += 1
+        jitter = abs(now - self.last_frame - self.period)
+        self.jitter_total += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.last_frame = now
+
+        # Missed one or more deadlines entirely. Don't try to catch up, just start over from here.
+        # Turbo never waits, so it always starts over, ready for when it's turned off.
+        late = now - self.deadline
+        if self.turbo: self.deadline = now
+        elif late >= self.period:
+            self.dropped += late // self.period
+            self.deadline = now
+        self.deadline += self.period
+
+    def set_turbo(self, turbo):
+        self.turbo = turbo
+        self.deadline = time.perf_counter_ns() + self.period
+
+    def print_stats(self):
+        if self.frames == 0: return
+        rate = f"{self.clock_hz} Hz" if self.clock_hz else "adaptive"
+        print(f"Paced {self.frames} frames ({'turbo' if self.turbo else rate}), dropped {self.dropped}, budget {self.budget} instructions")
+        print(f"...jitter {self.jitter_total / self.frames / 1e6:.3f}ms mean, {self.jitter_max / 1e6:.3f}ms max")
+
+# Set up breakpoints and watchpoints from the command line. Breakpoints are ADDR or ADDR:CONDITION.
+def add_debug_points(core, breaks, watches, read_watches):
+    for spec in breaks or []:
+        addr, _, condition = spec.partition(":")
+        core.add_breakpoint(int(addr, 0), condition or None)
+    for addr in watches or []: core.add_watchpoint(int(addr, 0))
+    for addr in read_watches or []: core.add_watchpoint(int(addr, 0), read=True, write=False)
+
+# Everything from the command line that has to happen to a fresh core before it runs.
+def setup_core(core, args):
+    if args.load is not None: core.restore(pf.Snapshot.load(args.load))
+    add_debug_points(core, args.breaks, args.watch, args.watch_read)
+
+def describe_hit(hit):
+    if hit[0] == "break": return f"Breakpoint at ${hit[1]:04x}"
+    if hit[0] == "read": return f"Read from ${hit[1]:04x}"
+    return f"Write of ${hit[2]:02x} to ${hit[1]:04x}"
+
+# The last few seconds of frames, for stepping backwards through. Each frame keeps RAM and VRAM as a
+# zlib'd XOR against the frame before, which is nearly all zeros, plus the registers and the rest of the
+# devices' state packed into a few bytes. The newest frame is also kept in full to work back from.
+class Rewinder():
+    def __init__(self, core, frames):
+        self.core = core
+        self.frames = collections.deque(maxlen=frames)
+        self.latest = None
+
+    def capture(self):
+        core = self.core
+        bus = core.io_handler
+        image = bytes(core.ram_view) + bytes(display.vram)
+        delta = None
+        if self.latest is not None: delta = zlib.compress(xor_bytes(image, self.latest), 1)
+        self.latest = image
+
+        regs = (core.a, core.d, core.num_pushes, core.next_sixteen, core.next_inhibit,
+                core.next_load_indirect, core.next_store_indirect, core.cycles)
+        devices = tuple(None if device is display else device.get_state() for start, length, device in bus.devices)
+        self.frames.append((delta, pf.SNAPSHOT_REGS.pack(*regs) + repr(devices).encode()))
+
+    # Go back a frame. Returns False if there's nothing further back to go to.
+    def step_back(self):
+        if len(self.frames) < 2: return False
+        delta, _ = self.frames.pop()
+        self.latest = xor_bytes(self.latest, zlib.decompress(delta))
+
+        core = self.core
+        state = self.frames[-1][1]
+        regs = pf.SNAPSHOT_REGS.unpack_from(state)
+        pages = {index: self.latest[index << 8:(index + 1) << 8] for index in range(0x40)}
+        core.restore(pf.Snapshot(pages, regs, None))
+
+        devices = ast.literal_eval(state[pf.SNAPSHOT_REGS.size:].decode())
+        for (start, length, device), device_state in zip(core.io_handler.devices, devices):
+            if device is not display: device.set_state(device_state)
+        display.set_state(self.latest[0x4000:])
+        return True
+
+    def size(self):
+        return sum(len(delta or b"") + len(state) for delta, state in self.frames) + len(self.latest or b"")
+
+# Controller input for every guest frame, plus the seed the run started from. Each frame has the four
+# controller bytes it started with, any changes partway through it (at so many cycles into the frame,
+# for guests that poll instead of waiting for frames), and a CRC of VRAM once it finished, so a replay
+# can tell exactly where it went its own way.
+INPUT_MAGIC = b"PONGOIN2"
+INPUT_FRAME = struct.Struct("<4BII")   # inputs, CRC, how many changes follow
+INPUT_CHANGE = struct.Struct("<4BQ")   # inputs, cycles into the frame
+
+class InputLog():
+    def __init__(self, seed, frames=()):
+        self.seed = seed
+        self.frames = list(frames)
+        self.pending = []
+        self.diverged = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    # Recording: changes come in as they happen, then the frame gets finished off with what it started with.
+    def change(self, cycles, inputs):
+        self.pending.append((cycles, tuple(inputs)))
+
+    def append(self, inputs, vram):
+        self.frames.append((tuple(inputs), zlib.crc32(vram), tuple(self.pending)))
+        self.pending = []
+
+    # Rewinding: forget the last finished frame, and anything since.
+    def drop_last(self):
+        if self.frames: self.frames.pop()
+        self.pending = []
+
+    def inputs(self, frame):
+        return self.frames[frame][0]
+
+    def changes(self, frame):
+        return self.frames[frame][2]
+
+    # Replaying: note the first frame that doesn't come out the same.
+    def check(self, frame, vram):
+        if self.diverged is None and self.frames[frame][1] != zlib.crc32(vram):
+            self.diverged = frame
+
+    def save(self, path):
+        with open(path, "wb") as outfile:
+            outfile.write(INPUT_MAGIC + struct.pack("<q", self.seed))
+            for inputs, crc, changes in self.frames:
+                outfile.write(INPUT_FRAME.pack(*inputs, crc, len(changes)))
+                for cycles, changed in changes: outfile.write(INPUT_CHANGE.pack(*changed, cycles))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as infile:
+            raw = infile.read()
+        if not raw.startswith(INPUT_MAGIC): raise ValueError(f"{path} isn't an input log")
+        seed = struct.unpack_from("<q", raw, len(INPUT_MAGIC))[0]
+
+        frames = []
+        pos = len(INPUT_MAGIC) + 8
+        while pos < len(raw):
+            *inputs, crc, count = INPUT_FRAME.unpack_from(raw, pos)
+            pos += INPUT_FRAME.size
+            changes = []
+            for i in range(count):
+                *changed, cycles = INPUT_CHANGE.unpack_from(raw, pos)
+                pos += INPUT_CHANGE.size
+                changes.append((cycles, tuple(changed)))
+            frames.append((tuple(inputs), crc, tuple(changes)))
+        return cls(seed, frames)
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+# Finished frames on their way from the emulator to the window. The guest draws into the display's
+# VRAM (the back buffer); each time it waits for a frame that gets copied to the front buffer, which
+# is all the window ever looks at. Inputs go the other way as a tuple, swapped in whole.
+class FrameExchange():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.front = bytearray(display_size[0] * display_size[1])
+        self.dirty_rows = bytearray(b"\x01" * display_size[1])
+        self.sequence = 0
+        self.shown = 0
+        self.inputs = (0, 0, 0, 0)
+
+    def publish(self, display):
+        with self.lock:
+            self.front[:] = display.vram
+            for row in range(display_size[1]):
+                if display.dirty_rows[row]: self.dirty_rows[row] = 1
+            self.sequence += 1
+        display.dirty_rows[:] = bytes(display_size[1])
+
+    # Window side: is there anything new to draw?
+    def poll(self):
+        if self.sequence == self.shown: return False
+        self.shown = self.sequence
+        return True
+
+# The same thing in shared memory, so the emulator can run in one process and any number of windows
+# (or recorders, or whatever) can watch from others. Layout:
+#   0-7      frame sequence number - odd while a frame is being written
+#   8-11     paddle_a, buttons_a, paddle_b, buttons_b
+#   16-143   the sequence number each row last changed in, 32 x 4 bytes
+#   144-1167 VRAM
+# Viewers draw straight out of the shared VRAM. If a frame lands halfway through, the rows it touched
+# have a newer sequence number than the viewer's seen, so they get drawn again next time round.
+class SharedFrame():
+    rows_at = 16
+    vram_at = 16 + display_size[1] * 4
+    size = vram_at + display_size[0] * display_size[1]
+
+    def __init__(self, name=None, create=False):
+        from multiprocessing import shared_memory
+
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=self.size if create else 0)
+        self.owner = create
+        if not create:
+            # Before 3.13, attaching registers the block to be cleaned up when we exit - even though
+            # it isn't ours to clean up.
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+            except Exception:
+                pass
+
+        self.buf = self.shm.buf
+        self.front = self.buf[self.vram_at:self.size]
+
+        # Viewer side bookkeeping.
+        self.lock = threading.Lock()
+        self.dirty_rows = bytearray(b"\x01" * display_size[1])
+        self.shown = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def sequence(self):
+        return struct.unpack_from("<Q", self.buf, 0)[0]
+
+    @property
+    def inputs(self):
+        return tuple(self.buf[8:12])
+
+    @inputs.setter
+    def inputs(self, values):
+        self.buf[8:12] = bytes(values)
+
+    def publish(self, display):
+        sequence = self.sequence + 2
+        struct.pack_into("<Q", self.buf, 0, sequence - 1)
+        self.front[:] = display.vram
+        for row in range(display_size[1]):
+            if display.dirty_rows[row]: struct.pack_into("<I", self.buf, self.rows_at + row * 4, sequence & 0xFFFFFFFF)
+        struct.pack_into("<Q", self.buf, 0, sequence)
+        display.dirty_rows[:] = bytes(display_size[1])
+
+    # Viewers: flag whatever changed since we last looked. Returns False if nothing did.
+    def poll(self):
+        sequence = self.sequence & ~1
+        if sequence == self.shown: return False
+        rows = struct.unpack_from(f"<{display_size[1]}I", self.buf, self.rows_at)
+        shown = self.shown & 0xFFFFFFFF
+        for row in range(display_size[1]):
+            if rows[row] > shown: self.dirty_rows[row] = 1
+        self.shown = sequence
+        return True
+
+    def close(self):
+        self.front.release()
+        self.buf = None
+        self.shm.close()
+        if self.owner: self.shm.unlink()
+
+# Runs the core on its own thread, so a slow window never holds up the guest. Keypresses come in
+# through the command queue; frames go out through the exchange.
+class EmulatorThread(threading.Thread):
+    def __init__(self, core, pacer, exchange, tracer=None, debugger=None, rewinder=None, input_log=None):
+        super().__init__(name="emulator", daemon=True)
+        self.core = core
+        self.pacer = pacer
+        self.exchange = exchange
+        self.tracer = tracer
+        self.debugger = debugger
+        self.rewinder = rewinder
+        self.input_log = input_log
+        self.inputs = (0, 0, 0, 0)
+        self.frame_inputs = self.inputs
+        self.frame_start = core.cycles
+        self.commands = queue.Queue()
+        self.running = True
+        self.step = False
+
+    def handle(self, command):
+        global pausing
+        global printing
+
+        if command == "quit": self.running = False
+        elif command == "pause": pausing = not pausing
+        elif command == "print": printing = not printing
+        elif command == "turbo": self.pacer.set_turbo(not self.pacer.turbo)
+        elif command == "step": self.step = pausing
+        elif command == "rewind" and self.rewinder is not None:
+            # Stay put on the frame we went back to until told otherwise.
+            pausing = True
+            if self.rewinder.step_back():
+                self.exchange.publish(display)
+                if self.input_log is not None: self.input_log.drop_last()
+                # The frame about to be run again starts from here, with whatever's held now.
+                self.latch_inputs()
+
+    # Input is latched at the start of each guest frame, and otherwise only between host frames, so a
+    # replay can give the guest exactly what it saw and when. Changes partway through a frame only
+    # matter to guests that poll for input without waiting for frames, but those would never see
+    # anything otherwise.
+    def latch_inputs(self, mid_frame=False):
+        inputs = self.exchange.inputs
+        if mid_frame:
+            if inputs == self.inputs: return
+            if self.input_log is not None: self.input_log.change(self.core.cycles - self.frame_start, inputs)
+        else:
+            self.frame_inputs = inputs
+            self.frame_start = self.core.cycles
+        self.inputs = inputs
+        controllers.set_state(inputs)
+
+    def run(self):
+        global pausing
+        global printing
+
+        core = self.core
+        pacer = self.pacer
+        self.latch_inputs()
+
+        # Each trip round the loop is one host frame, worth however many instructions the pacer says.
+        frame_end = core.cycles + pacer.budget
+
+        while self.running:
+            while not self.commands.empty(): self.handle(self.commands.get())
+            # While the debugger has us stopped, wait on it instead of going round as fast as we can.
+            if self.debugger is not None: self.debugger.service(core, wait=self.debugger.paused)
+            held = self.debugger is not None and self.debugger.paused
+
+            # Execute an instruction.
+            if (not pausing or self.step) and not held:
+                if printing:
+                    # One instruction at a time, still stopping at breakpoints.
+                    print_state(core)
+                    if self.tracer is not None: self.tracer.run_until(core, core.cycles + 1)
+                    else: core.run_debug(core.cycles + 1, resume_ip=core.resume_from_hit())
+                else:
+                    # Run up to the end of the frame. If the guest is waiting for the next one, there's
+                    # nothing left to do this frame, so skip the rest of it.
+                    begin_cycles = core.cycles - core.skipped_cycles
+                    begin_time = time.perf_counter_ns()
+                    if self.tracer is not None: self.tracer.run_until(core, frame_end, lambda: emuflow.waiting_frame)
+                    else: core.run_until(frame_end, lambda: emuflow.waiting_frame)
+                    pacer.ran(core.cycles - core.skipped_cycles - begin_cycles, time.perf_counter_ns() - begin_time)
+
+                    # In turbo there's no frame to wait out, so just carry on with the next one.
+                    if emuflow.waiting_frame and not pacer.turbo: core.skip_to(frame_end)
+
+                if emuflow.waiting_frame:
+                    self.exchange.publish(display)
+                    emuflow.waiting_frame = False
+                    if self.rewinder is not None: self.rewinder.capture()
+                    if self.input_log is not None: self.input_log.append(self.frame_inputs, display.vram)
+                    self.latch_inputs()
+
+                # The guest asked to stop and have a look around, or ran into a breakpoint.
+                if emuflow.pause_requested:
+                    pausing = True
+                    printing = True
+                    emuflow.pause_requested = False
+
+                if core.hit is not None:
+                    print(describe_hit(core.hit))
+                    if self.debugger is not None:
+                        self.debugger.stopped(core.hit)
+                    else:
+                        pausing = True
+                        printing = True
+
+                self.step = False
+
+            # Sleep off the rest of the frame instead of spinning. Halted guests land here too, since the
+            # core fast-forwards through jumps to self. Single-stepping goes as fast as it can.
+            if core.cycles >= frame_end or pausing or not printing:
+                pacer.wait()
+                frame_end = core.cycles + pacer.budget
+                self.latch_inputs(mid_frame=True)
+
+def load_rom(path):
+    with open(path, "rb") as binfile:
+        contents = [e for e in bytearray(binfile.read())]
+    return contents[0x8000:]
+
+# Save the framebuffer. PNGs get the palette, anything else is just the raw color indices.
+def dump_framebuffer(path):
+    if path.lower().endswith(".png"):
+        from PIL import Image
+
+        img = Image.frombytes("P", display_size, bytes(display.vram))
+        img.putpalette(load_palette())
+        img.save(path)
+    else:
+        with open(path, "wb") as outfile:
+            outfile.write(display.vram)
+
+# The frame loop for running without a window: runs the core until it's done the given number of frames
+# or instructions, whichever comes first, and returns how many frames it did. Guests waiting for a
+# frame get the next one straight away.
+# Pass a SharedFrame as the exchange to let viewers watch (and play), a TraceRecorder (or Profiler) to
+# trace, a DebugServer to take commands between frames, an InputLog to replay (the RNG needs seeding
+# to match it first), another InputLog to record into, and on_frame to be called as each frame finishes.
+def run_frames(core, frames=None, instructions=None, exchange=None, tracer=None, debugger=None, replay=None, record=None, on_frame=None):
+    frame_count = 0
+    # Viewers' input goes in between chunks, so keep them short enough to feel responsive.
+    chunk = 1000000 if exchange is None or replay is not None else 20000
+    if replay is not None and len(replay): controllers.set_state(replay.inputs(0))
+    elif exchange is not None and replay is None: controllers.set_state(exchange.inputs)
+    changes = list(replay.changes(0)) if replay is not None and len(replay) else []
+    frame_start = core.cycles
+    frame_inputs = controllers.get_state()
+
+    # Input that changes partway through a frame, so the recording gets it at the same point.
+    def change_inputs(inputs):
+        if record is not None and tuple(inputs) != controllers.get_state(): record.change(core.cycles - frame_start, inputs)
+        controllers.set_state(inputs)
+
+    while True:
+        if frames is not None and frame_count >= frames: break
+        if instructions is not None and core.cycles >= instructions: break
+
+        if debugger is not None:
+            debugger.service(core, wait=debugger.paused)
+            if debugger.paused: continue
+        if exchange is not None and replay is None: change_inputs(exchange.inputs)
+
+        # Replayed input that changed partway through a frame goes in at exactly the same point.
+        while changes and changes[0][0] <= core.cycles - frame_start: change_inputs(changes.pop(0)[1])
+
+        target = core.cycles + chunk
+        if instructions is not None: target = min(target, instructions)
+        if changes: target = min(target, frame_start + changes[0][0])
+        if tracer is not None: tracer.run_until(core, target, lambda: emuflow.waiting_frame)
+        else: core.run_until(target, lambda: emuflow.waiting_frame)
+
+        if core.hit is not None:
+            print(describe_hit(core.hit))
+            if debugger is None: break
+            debugger.stopped(core.hit)
+
+        # Nobody's around to unpause us, so a pause is just another frame.
+        if emuflow.waiting_frame:
+            if replay is not None and frame_count < len(replay): replay.check(frame_count, display.vram)
+            if record is not None: record.append(frame_inputs, display.vram)
+            if on_frame is not None: on_frame()
+            frame_count += 1
+            if exchange is not None: exchange.publish(display)
+            emuflow.waiting_frame = False
+            emuflow.pause_requested = False
+            if replay is not None and frame_count < len(replay):
+                controllers.set_state(replay.inputs(frame_count))
+                changes = list(replay.changes(frame_count))
+            elif exchange is not None and replay is None:
+                controllers.set_state(exchange.inputs)
+            frame_start = core.cycles
+            frame_inputs = controllers.get_state()
+
+    return frame_count
+
+# Run with no window at all, as fast as the host can go, and say how fast that was. Takes the same
+# options as run_frames; swap in a different bus to stub out devices.
+def run_headless(rom, frames=None, instructions=None, dump=None, bus=None, exchange=None, tracer=None, setup=None, debugger=None, replay=None, record=None):
+    core = pf.PongoCore(rom, bus if bus is not None else build_bus())
+    if setup is not None: setup(core)
+    print(f"Random seed {rng.seed}")
+
+    begin_time = time.perf_counter()
+    frame_count = run_frames(core, frames, instructions, exchange, tracer, debugger, replay, record)
+    total_time = time.perf_counter() - begin_time
+
+    print(f"Ran {core.cycles} instructions ({core.skipped_cycles} skipped as idle) and {frame_count} frames in {total_time:.3f}s")
+    if total_time > 0:
+        print(f"...{core.cycles / total_time:.0f} instructions/sec, {frame_count / total_time:.1f} frames/sec")
+
+    if replay is not None:
+        if replay.diverged is not None: print(f"Replay diverged at frame {replay.diverged}")
+        else: print(f"Replay matched {min(frame_count, len(replay))} of {len(replay)} frames")
+
+    if dump is not None: dump_framebuffer(dump)
+    return core
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pongo v4 emulator")
+    parser.add_argument("rom", nargs="?", help="binary to run (from impede)")
+    parser.add_argument("--seed", type=int, help="seed for the random number device (default: pick one)")
+    parser.add_argument("--headless", action="store_true", help="no window, just run as fast as possible")
+    parser.add_argument("--frames", type=int, help="headless: stop after this many frames")
+    parser.add_argument("--instructions", type=int, help="headless: stop after this many instructions")
+    parser.add_argument("--dump", help="headless: save the final framebuffer here (.png, or raw otherwise)")
+    parser.add_argument("--fps", type=int, default=75, help="host frames per second (default: 75)")
+    parser.add_argument("--clock", type=float, help="fixed clock rate in MHz (default: as fast as the host keeps up)")
+    parser.add_argument("--turbo", action="store_true", help="don't wait for frames at all (t toggles)")
+    parser.add_argument("--serve", nargs="?", const="", help="no window, publish frames to shared memory (optionally with this name)")
+    parser.add_argument("--attach", help="don't emulate, just watch the shared memory another emulator is serving")
+    parser.add_argument("--trace", help="record every instruction to this file (read it with tracefour.py)")
+    parser.add_argument("--profile", metavar="FILE", help="count where the cycles go and save it here (read it with proffour.py)")
+    parser.add_argument("--break", dest="breaks", action="append", metavar="ADDR[:COND]", help="stop at this address, e.g. 0x8011 or 0x8011:loop<3")
+    parser.add_argument("--watch", action="append", metavar="ADDR", help="stop after writes to this address")
+    parser.add_argument("--watch-read", action="append", metavar="ADDR", help="stop after reads from this address")
+    parser.add_argument("--rewind", type=float, default=60, help="seconds of frames to keep for rewinding with r (default: 60, 0 turns it off)")
+    parser.add_argument("--record", metavar="FILE", help="log input each frame, for --replay")
+    parser.add_argument("--replay", metavar="FILE", help="headless: play back a --record log as fast as possible and check the frames match")
+    parser.add_argument("--load", metavar="SNAPSHOT", help="start from a saved snapshot instead of a reset")
+    parser.add_argument("--debug", metavar="PORT|PATH", help="take debugger commands on this local port or Unix socket (see debugfour.py)")
+    args = parser.parse_args()
+
+    replay = None
+    if args.replay is not None:
+        replay = InputLog.load(args.replay)
+        args.headless = True
+        args.seed = replay.seed
+        if args.frames is None: args.frames = len(replay)
+    rng.reseed(args.seed)
+    input_log = InputLog(rng.seed) if args.record is not None else None
+
+    if args.rom is None and args.attach is None:
+        parser.error("need a ROM to run, or --attach")
+    for spec in args.breaks or []:
+        condition = spec.partition(":")[2]
+        try:
+            if condition: pf.compile_condition(condition)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # A served block of shared memory outlives us unless we unlink it, so being killed has to go
+    # through the same cleanup as ^C.
+    if args.serve is not None: signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    tracer = None
+    if args.trace is not None:
+        import tracefour
+        tracer = tracefour.TraceRecorder(args.trace)
+
+    # The profiler sees every instruction the same way the tracer does, so it goes in the same place.
+    if args.profile is not None:
+        if tracer is not None: parser.error("--trace and --profile don't go together")
+        import proffour
+        budget = int(args.clock * 1000000) // args.fps if args.clock else None
+        tracer = proffour.Profiler(args.profile, budget, args.rom)
+
+    debugger = None
+    if args.debug is not None:
+        import debugfour
+        debugger = debugfour.DebugServer(args.debug)
+        print(f"Debugger listening on {args.debug}")
+
+    if args.headless:
+        if args.frames is None and args.instructions is None:
+            parser.error("--headless needs --frames or --instructions")
+        exchange = SharedFrame(args.serve or None, create=True) if args.serve is not None else None
+        if exchange is not None: print(f"Serving frames as {exchange.name}")
+        try:
+            run_headless(load_rom(args.rom), args.frames, args.instructions, args.dump, exchange=exchange, tracer=tracer,
+                         setup=lambda core: setup_core(core, args), debugger=debugger, replay=replay, record=input_log)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if exchange is not None: exchange.close()
+            if tracer is not None: tracer.close()
+            if debugger is not None: debugger.close()
+            if input_log is not None:
+                input_log.save(args.record)
+                print(f"Recorded {len(input_log)} frames of input")
+        sys.exit(1 if replay is not None and replay.diverged is not None else 0)
+
+    clock_hz = int(args.clock * 1000000) if args.clock else None
+
+    # No window here - the emulator runs flat out on this thread, and viewers attach from elsewhere.
+    if args.serve is not None:
+        exchange = SharedFrame(args.serve or None, create=True)
+        print(f"Serving frames as {exchange.name}, watch with --attach {exchange.name}")
+        core = pf.PongoCore(load_rom(args.rom), build_bus())
+        setup_core(core, args)
+        print(f"Random seed {rng.seed}")
+        pacer = FramePacer(args.fps, clock_hz, args.turbo)
+
+        pausing = False
+        printing = False
+        try:
+            EmulatorThread(core, pacer, exchange, tracer, debugger, input_log=input_log).run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            exchange.close()
+            if tracer is not None: tracer.close()
+            if debugger is not None: debugger.close()
+            if input_log is not None: input_log.save(args.record)
+
+        print(f"Skipped {core.skipped_cycles} idle instructions")
+        pacer.print_stats()
+        sys.exit(0)
+
+    import pygame
+    import numpy as np
 
     pygame.init()
     screen = pygame.display.set_mode(display_scaled)
-    fb = pygame.Surface(display_size).convert(8)
     sfb = pygame.Surface(display_scaled).convert(8)
     pygame.key.set_repeat(500, 50)
 
     # Set up the terminal.
-    fb.fill(pygame.Color(0, 255, 255))
+    raw_palette = load_palette()
+    sfb.set_palette([tuple(raw_palette[c:c + 3]) for c in range(0, 768, 3)])
 
-    with open("xterm_colors.json", "r") as palette:
-        colo = json.loads(palette.read())
-        for c in colo:
-            fb.set_palette_at(int(c), (colo[c]["r"], colo[c]["g"], colo[c]["b"]))
+    if args.attach is not None:
+        # Someone else is running the show. All we can do is send them the mouse.
+        exchange = SharedFrame(args.attach)
+        emulator = None
+    else:
+        exchange = FrameExchange()
 
-    sfb.set_palette(fb.get_palette())
+        # Make a core.
+        core = pf.PongoCore(load_rom(args.rom), build_bus())
+        setup_core(core, args)
+        print(f"Random seed {rng.seed}")
 
-    # Assemble the program.
-    with open(sys.argv[1], "rb") as binfile:
-        contents = [e for e in bytearray(binfile.read())]
+        pacer = FramePacer(args.fps, clock_hz, args.turbo)
+        rewinder = Rewinder(core, int(args.rewind * args.fps)) if args.rewind > 0 else None
+        emulator = EmulatorThread(core, pacer, exchange, tracer, debugger, rewinder, input_log)
+        emulator.start()
 
-    # Make a core.
-    core = pf.PongoCore(contents[0x8000:], pongo_io)
-   
-    # Benchmark the core.
-    begin_time = pygame.time.get_ticks()
-    for i in range(10000): core.spin()
-    total_time = pygame.time.get_ticks() - begin_time
-    print(f"Ran 10,000 instructions in {total_time}ms...")
-    
-    spins_per_frame = int((1000 / 75) / (total_time / 10000))
-    # note: timer resolution is ~10ms so this can prolly run faster even
-    print(f"...running {spins_per_frame} instructions per frame")
-
-    core.reset(True)
-
-    # And repeat.
+    # A view onto the front buffer, so drawing doesn't have to copy it first.
+    vram_array = np.frombuffer(exchange.front, dtype=np.uint8).reshape(display_size[1], display_size[0])
+
+    # The window just keeps up with input and draws whatever the emulator last finished.
+    clock = pygame.time.Clock()
     run = True
-    paused = True
 
     while run:
         # Handle I/O.
@@ -118,38 +938,43 @@ if __name__ == "__main__":
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     run = False
+                elif emulator is None:
+                    pass
                 elif event.key == pygame.K_p:
-                    pausing = not pausing
+                    emulator.commands.put("pause")
                 elif event.key == pygame.K_o:
-                    printing = not printing
+                    emulator.commands.put("print")
+                elif event.key == pygame.K_t:
+                    emulator.commands.put("turbo")
+                elif event.key == pygame.K_r:
+                    emulator.commands.put("rewind")
                 elif event.key == pygame.K_RETURN:
-                    if pausing:
-                        paused = False
-
-        mpos = pygame.mouse.get_pos()
-        paddle_a = int(mpos[0] / 32) % 32
-        paddle_b = int(mpos[1] / 32) % 32
-        buttons_a = 1 if pygame.mouse.get_pressed()[0] else 0
-
-        if waiting_frame:
-            pygame.transform.scale(fb, display_scaled, dest_surface=sfb)
-            screen.blit(sfb, (0, 0))
-            pygame.display.update()
-
-            # pygame.time.wait(16)
-            waiting_frame = False
-        
-        # Execute an instruction.
-        if not pausing or (pausing and not paused):
-            if printing:
-                print_state(core)
-                core.spin()
-            else:
-                # Run as many as you can.
-                for i in range(spins_per_frame):
-                    if waiting_frame: break
-                    core.spin()
-
-            paused = True
+                    emulator.commands.put("step")
+
+        # Only the window the mouse is over gets a say, so viewers don't take turns overwriting each other.
+        if pygame.mouse.get_focused():
+            mpos = pygame.mouse.get_pos()
+            exchange.inputs = (int(mpos[0] / 32) % 32, 1 if pygame.mouse.get_pressed()[0] else 0, int(mpos[1] / 32) % 32, 0)
+
+        if exchange.poll(): present(screen)
+
+        clock.tick(args.fps)
+
+    if emulator is not None:
+        emulator.commands.put("quit")
+        emulator.join()
+        if tracer is not None: tracer.close()
+        if debugger is not None: debugger.close()
+        if input_log is not None:
+            input_log.save(args.record)
+            print(f"Recorded {len(input_log)} frames of input")
+
+        print(f"Skipped {core.skipped_cycles} idle instructions")
+        if rewinder is not None: print(f"Rewind buffer holds {len(rewinder.frames)} frames in {rewinder.size() / 1024:.0f}KiB")
+        pacer.print_stats()
+    print_frame_stats()
 
+    # Let go of the shared memory before closing it.
+    vram_array = None
+    if args.attach is not None: exchange.close()
     pygame.quit()
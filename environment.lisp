@@ -356,6 +356,16 @@
   (with-open-file (stream filename :direction :output :element-type 'unsigned-byte :if-exists :supersede) (write-sequence src-array stream))
 )
 
+; And the labels next to it, for the profiler. A line per label: address in hex, then the name, in address order.
+(defun write-symbols (filename)
+  (let* ((symbols nil))
+    (maphash (lambda (key val) (push (cons val key) symbols)) *label-mapping*)
+    (with-open-file (stream filename :direction :output :if-exists :supersede)
+      (mapcar (lambda (sym) (format stream "~4,'0X ~A~%" (car sym) (cdr sym)))
+        (stable-sort (sort symbols #'string< :key #'cdr) #'< :key #'car)))
+  )
+)
+
 ; I attempted to convert "labels" to use local variables here, but it caused more problems than it solved.
 ; Seems related to scoping within read-source, since it'd choke on labels defined in included files.
 ; Not a big deal to pollute the global namespace - we're either loading it into SBCL (so nothing happens
@@ -369,6 +379,7 @@
       (spacing-pass dec-code)
       (binary-pass dec-code)
       (write-binary *out-bin* fileout)
+      (write-symbols (make-pathname :type "sym" :defaults fileout))
     )
   )
 )
@@ -1,7 +1,8 @@
 import os
+import ast
 import sys
-import json
-import random
+import zlib
+import struct
 from enum import IntEnum
 
 
@@ -39,10 +40,218 @@ class FlowLines(IntEnum):
     WaitForFrame  = 0x80,  # pauses execution until the next frametime
 
 
+# Sign extension, precomputed. EXTEND_TABLES[pushes][(A | data) & EXTEND_MASKS[pushes]] is the A an
+# instruction actually sees after that many pushes.
+EXTEND_MASKS = (0x3F, 0xFFF, 0xFFFF)
+EXTEND_TABLES = (
+    [v | 0xFFC0 if v & 0x20 else v for v in range(0x40)],
+    [v | 0xF000 if v & 0x800 else v for v in range(0x1000)],
+    range(0x10000),
+)
+
+# Pushes flip-flop between the two high chunks of A. PUSH_KEEP[pushes & 1] clears the chunk about to be
+# written, and PUSH_CHUNKS[pushes & 1][data] is what goes in it.
+PUSH_KEEP = (~0xFC0 & 0xFFFF, ~0xF000 & 0xFFFF)
+PUSH_CHUNKS = ([data << 6 for data in range(0x40)], [(data << 12) & 0xFFFF for data in range(0x40)])
+
+# The A an instruction sees, given the A register, how many pushes led up to it and its own data bits.
+# If the pushes are sitting right there in ROM, this can be worked out ahead of time.
+def a_effective(a, num_pushes, data):
+    if num_pushes > 2: raise RuntimeWarning("Too many pushes in a row")
+    return EXTEND_TABLES[num_pushes][(a | data) & EXTEND_MASKS[num_pushes]]
+
+# The A register after a push.
+def push_a(a, num_pushes, data):
+    side = num_pushes & 1
+    return (a & PUSH_KEEP[side]) | PUSH_CHUNKS[side][data]
+
+
+# Side effects of a Flow write, one precompiled function per possible byte (None if there aren't any).
+# Same order as the circuit: latch the pending flags, then bump the counters.
+def flow_action_source(data):
+    lines = []
+    if data & FlowLines.SixteenWide: lines.append("core.next_sixteen = True")
+    if data & FlowLines.InhibitIfZero: lines.append("core.next_inhibit = True")
+    if data & FlowLines.LoadIndirect: lines.append("core.next_load_indirect = True")
+    if data & FlowLines.StoreIndirect: lines.append("core.next_store_indirect = True")
+
+    counters = []
+    if data & FlowLines.LoopDown: counters.append((int(Regs.LoopLo), "- 1", 0xFF))
+    if data & FlowLines.IndirectUp: counters.append((int(Regs.IndiLo), "+ 1", 0x00))
+    if data & FlowLines.IndirectDown: counters.append((int(Regs.IndiLo), "- 1", 0xFF))
+    if counters: lines.append("ram = core.ram")
+    for base, step, carry in counters:
+        lines.append(f"low = (ram[{base}] {step}) & 0xFF; ram[{base}] = low")
+        lines.append(f"if low == {carry}: ram[{base + 1}] = (ram[{base + 1}] {step}) & 0xFF")
+
+    if not lines: return None
+    return f"def flow_{data:02x}(core):\n    " + "\n    ".join(lines) + "\n"
+
+# The top bit doesn't do anything in the core, so only half of these are actually different.
+# They all get compiled in one go to keep startup quick.
+def build_flow_actions():
+    sources = {data: flow_action_source(data) for data in range(0x80)}
+    scope = {}
+    exec("".join(src for src in sources.values() if src is not None), scope)
+    actions = [scope[f"flow_{data:02x}"] if sources[data] is not None else None for data in range(0x80)]
+    return actions + actions
+
+FLOW_ACTIONS = build_flow_actions()
+
+
+# Memory-mapped I/O. Devices claim a range of the I/O window, and a table with one entry per address
+# sends each access straight to the right one. Offsets are from the start of the I/O window ($4000).
+class Device():
+    # Both get the offset from the start of the device's own range.
+    def read(self, offset):
+        return 0xEA
+
+    def write(self, offset, data):
+        pass
+
+    # What read() would give, without it counting as a read, for debuggers. Devices whose reads
+    # change something have to override it.
+    def peek(self, offset):
+        return self.read(offset)
+
+    # For snapshots. Whatever comes back has to be built from None, bools, ints, bytes and tuples,
+    # so it can be written to a file.
+    def get_state(self):
+        return None
+
+    def set_state(self, state):
+        pass
+
+class DeviceBus():
+    def __init__(self, size=0x4000):
+        self.size = size
+        self.devices = []
+
+        # Nothing attached reads as $EA and ignores writes.
+        self.unmapped = Device()
+        self.owners = [self.unmapped] * size
+        self.readers = [self.unmapped.read] * size
+        self.writers = [self.unmapped.write] * size
+        self.bases = [0] * size
+
+    # Hook a device up to a range of the I/O window. Later devices win if they overlap.
+    def attach(self, device, start, length=1):
+        if start < 0 or start + length > self.size: raise ValueError("device doesn't fit in the I/O window")
+        self.devices.append((start, length, device))
+
+        for offset in range(start, start + length):
+            self.owners[offset] = device
+            self.readers[offset] = device.read
+            self.writers[offset] = device.write
+            self.bases[offset] = start
+
+        return device
+
+    def read(self, offset):
+        return self.readers[offset](offset - self.bases[offset])
+
+    def peek(self, offset):
+        return self.owners[offset].peek(offset - self.bases[offset])
+
+    def write(self, offset, data):
+        self.writers[offset](offset - self.bases[offset], data)
+
+    def get_state(self):
+        return tuple(device.get_state() for start, length, device in self.devices)
+
+    def set_state(self, state):
+        for (start, length, device), device_state in zip(self.devices, state): device.set_state(device_state)
+
+    # A run of writes in one go. Devices that implement write_block() get it all at once if it's entirely theirs.
+    def write_block(self, offset, data):
+        device = self.owners[offset]
+        end = offset + len(data) - 1
+        if hasattr(device, "write_block") and self.owners[end] is device and self.bases[end] == self.bases[offset]:
+            device.write_block(offset - self.bases[offset], data)
+        else:
+            for i in range(len(data)): self.write(offset + i, data[i])
+
+
+# A saved machine: RAM, the registers that don't live in RAM, and the state of the devices on the bus.
+# RAM is kept as 256-byte pages. A snapshot taken against a base only keeps the pages that differ from it,
+# so taking one every frame is cheap; ROM never changes, so it isn't kept at all.
+SNAPSHOT_MAGIC = b"PONGOSS1"
+SNAPSHOT_REGS = struct.Struct("<HHB4?Q")
+
+class Snapshot():
+    def __init__(self, pages, regs, devices, base=None):
+        self.pages = pages      # page number -> 256 bytes
+        self.regs = regs        # a, d, num_pushes, the four pending flags, cycles
+        self.devices = devices  # DeviceBus state, or None
+        self.base = base        # where the missing pages are
+
+    def page(self, index):
+        page = self.pages.get(index)
+        return page if page is not None else self.base.page(index)
+
+    def ram(self):
+        return b"".join(self.page(index) for index in range(0x40))
+
+    # Files always hold the whole of RAM, so they don't depend on anything else.
+    def save(self, path):
+        payload = SNAPSHOT_REGS.pack(*self.regs) + self.ram() + repr(self.devices).encode()
+        with open(path, "wb") as outfile:
+            outfile.write(SNAPSHOT_MAGIC + zlib.compress(payload, 9))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as infile:
+            raw = infile.read()
+        if not raw.startswith(SNAPSHOT_MAGIC): raise ValueError(f"{path} isn't a snapshot")
+        payload = zlib.decompress(raw[len(SNAPSHOT_MAGIC):])
+
+        regs = SNAPSHOT_REGS.unpack_from(payload)
+        ram_at = SNAPSHOT_REGS.size
+        pages = {index: payload[ram_at + index * 256:ram_at + (index + 1) * 256] for index in range(0x40)}
+        devices = ast.literal_eval(payload[ram_at + 0x4000:].decode())
+        return cls(pages, regs, devices)
+
+
+# Breakpoint conditions can come in over the debug socket, so they're only allowed arithmetic, comparisons
+# and and/or/not over whole numbers, the names debug_names() gives and ram[...]. Anything else (calls,
+# attributes, strings, unknown names) is turned away up front with a ValueError.
+CONDITION_NAMES = {"a", "d", "ip", "loop", "indi", "pushes", "cycles", "ram"}
+CONDITION_NODES = (
+    ast.Expression, ast.Load, ast.Name, ast.Constant, ast.Subscript, ast.IfExp,
+    ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd, ast.Invert,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod, ast.BitAnd, ast.BitOr, ast.BitXor, ast.RShift,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+def compile_condition(text):
+    try:
+        tree = ast.parse(text, "<breakpoint>", "eval")
+    except SyntaxError as e:
+        raise ValueError(f"bad condition {text!r}: {e.msg}")
+    for node in ast.walk(tree):
+        if not isinstance(node, CONDITION_NODES):
+            raise ValueError(f"bad condition {text!r}: can't use {type(node).__name__}")
+        if isinstance(node, ast.Name) and node.id not in CONDITION_NAMES:
+            raise ValueError(f"bad condition {text!r}: no such name {node.id}")
+        if isinstance(node, ast.Constant) and type(node.value) is not int:
+            raise ValueError(f"bad condition {text!r}: only whole numbers")
+        if isinstance(node, ast.Subscript) and not (isinstance(node.value, ast.Name) and node.value.id == "ram"):
+            raise ValueError(f"bad condition {text!r}: only ram can be indexed")
+
+    code = compile(tree, "<breakpoint>", "eval")
+    # Reading past the end of RAM or dividing by zero stops there, so there's a chance to look.
+    def condition(core):
+        try:
+            return eval(code, {"__builtins__": {}}, core.debug_names())
+        except (ArithmeticError, IndexError):
+            return True
+    return condition
+
+
 class PongoCore():
     # Reset machine state.
     def reset(self, also_ram=False):
-        if also_ram: self.ram = [0] * 16384
+        if also_ram: self.ram_view[:] = bytes(len(self.ram_view))
         self.ram[Regs.IpHi] = 0x80
         self.a = 0
         self.d = 0
@@ -51,27 +260,174 @@ class PongoCore():
         self.next_load_indirect = False
         self.next_store_indirect = False
         self.next_inhibit = False
+        self.cycles = 0
+        self.skipped_cycles = 0
 
     # Construct a new core.
     def __init__(self, rom, io=None):
-        self.rom = rom
+        # The whole address space lives in one bytearray. RAM sits at the bottom, so self.ram can be indexed
+        # with plain addresses; the views are for anyone who wants to look at one region without copying it.
+        self.memory = bytearray(0x10000)
+        rom = bytes(b & 0xFF for b in rom[:0x8000])
+        self.memory[0x8000:0x8000 + len(rom)] = rom
+
+        view = memoryview(self.memory)
+        self.ram = self.memory
+        self.ram_view = view[0x0000:0x4000]
+        self.io_view = view[0x4000:0x8000]
+        self.rom = view[0x8000:0x8000 + len(rom)]
+
+        # I/O is either a DeviceBus or a plain function taking (offset, data=None).
         self.io_handler = io
+        if isinstance(io, DeviceBus):
+            self.io_read = io.read
+            self.io_write = io.write
+        else:
+            self.io_read = io
+            self.io_write = io
+
+        # Debugging. Breakpoints map addresses to a condition (or None to always stop); watches are sets
+        # of addresses. When something's hit, it's described in self.hit.
+        self.breakpoints = {}
+        self.read_watches = set()
+        self.write_watches = set()
+        self.hit = None
+
+        self.build_pages()
         self.reset(True)
+        self.predecode()
+        self.blocks = {}
+
+    # Builds the page table: one read and one write handler per 256 bytes of address space.
+    # None means plain memory, which get() and set() handle without a call. The zero page is plain too,
+    # apart from Nand and Flow, which get() and set() pick out themselves.
+    def build_pages(self):
+        self.read_pages = [None] * 256
+        self.write_pages = [None] * 256
+
+        for page in range(0x40, 0x80):
+            self.read_pages[page] = self.read_io
+            self.write_pages[page] = self.write_io
+
+        for page in range(0x80, 0x100):
+            self.write_pages[page] = self.write_rom
+
+    # Save everything needed to come back to this exact point. With a base, only pages of RAM that differ
+    # from it are kept. Deltas are always against a full snapshot, so the chain never gets deeper than one.
+    def snapshot(self, base=None):
+        if base is not None and base.base is not None: base = base.base
+
+        memory = self.memory
+        if base is None:
+            pages = {index: bytes(memory[index << 8:(index + 1) << 8]) for index in range(0x40)}
+        else:
+            pages = {}
+            for index in range(0x40):
+                page = memory[index << 8:(index + 1) << 8]
+                if page != base.pages[index]: pages[index] = bytes(page)
+
+        regs = (self.a, self.d, self.num_pushes, self.next_sixteen, self.next_inhibit,
+                self.next_load_indirect, self.next_store_indirect, self.cycles)
+        devices = self.io_handler.get_state() if isinstance(self.io_handler, DeviceBus) else None
+        return Snapshot(pages, regs, devices, base)
+
+    def restore(self, snapshot):
+        self.ram_view[:] = snapshot.ram()
+        (self.a, self.d, self.num_pushes, self.next_sixteen, self.next_inhibit,
+         self.next_load_indirect, self.next_store_indirect, self.cycles) = snapshot.regs
+        if snapshot.devices is not None and isinstance(self.io_handler, DeviceBus):
+            self.io_handler.set_state(snapshot.devices)
+        self.hit = None
+
+    # Breakpoints and watchpoints. None of them cost anything until the first one's set: run_until switches
+    # to a slower loop that checks them, and watched pages get a handler that notices the access.
+    # Conditions are either a function taking the core, or an expression over a, d, ip, loop, indi,
+    # pushes, cycles and ram, e.g. "d == 3 and ram[0xb] > 8".
+    def add_breakpoint(self, addr, condition=None):
+        if isinstance(condition, str): condition = compile_condition(condition)
+        self.breakpoints[addr & 0xFFFF] = condition
+
+    def remove_breakpoint(self, addr):
+        self.breakpoints.pop(addr & 0xFFFF, None)
+
+    def add_watchpoint(self, addr, read=False, write=True):
+        if read: self.read_watches.add(addr & 0xFFFF)
+        if write: self.write_watches.add(addr & 0xFFFF)
+        self.watch_pages()
+
+    def remove_watchpoint(self, addr):
+        self.read_watches.discard(addr & 0xFFFF)
+        self.write_watches.discard(addr & 0xFFFF)
+        self.watch_pages()
+
+    def debugging(self):
+        return bool(self.breakpoints or self.read_watches or self.write_watches)
+
+    def debug_names(self):
+        ram = self.ram
+        return {
+            "a": self.a, "d": self.d, "ip": ram[Regs.IpHi] << 8 | ram[Regs.IpLo],
+            "loop": ram[Regs.LoopHi] << 8 | ram[Regs.LoopLo], "indi": ram[Regs.IndiHi] << 8 | ram[Regs.IndiLo],
+            "pushes": self.num_pushes, "cycles": self.cycles, "ram": ram,
+        }
+
+    # Rebuild the page table with watching handlers in front of any page that has a watch on it.
+    # Counter updates (Ip, Loop, Indi stepping) go straight to RAM and don't trip watches.
+    def watch_pages(self):
+        self.build_pages()
+        for page in {addr >> 8 for addr in self.read_watches}:
+            self.read_pages[page] = self.watched_read(self.read_registers if page == 0 else self.read_pages[page])
+        for page in {addr >> 8 for addr in self.write_watches}:
+            self.write_pages[page] = self.watched_write(self.write_registers if page == 0 else self.write_pages[page])
+
+    def watched_read(self, inner):
+        def read(addr):
+            if addr in self.read_watches: self.hit = ("read", addr)
+            return self.memory[addr] if inner is None else inner(addr)
+        return read
+
+    def watched_write(self, inner):
+        def write(addr, data):
+            if addr in self.write_watches: self.hit = ("write", addr, data)
+            if inner is None: self.memory[addr] = data
+            else: inner(addr, data)
+        return write
+
+    # Split every ROM byte into opcode, data and handler ahead of time, so spin() doesn't have to.
+    # ROM can't be written by the guest, so this only needs doing once.
+    # Each entry also has the final A worked out, assuming the pushes right before it in ROM were what led
+    # here. That's the only way to arrive with that many pushes (jumps clear them), so spin() can use it
+    # whenever num_pushes matches. Pushes themselves get None there.
+    def predecode(self):
+        handlers = (self.exec_asmovd, self.exec_amovd, self.exec_dmovas, self.exec_push)
+        self.decoded = []
+        static_a = 0
+        static_pushes = 0
+        for inst in self.rom:
+            opcode = inst >> 6
+            data = inst & 0x3F
+            if opcode == Opcodes.PushA:
+                self.decoded.append((opcode, data, handlers[opcode], None, None))
+                static_a = push_a(static_a, static_pushes, data)
+                static_pushes += 1
+            else:
+                if static_pushes > 2: self.decoded.append((opcode, data, handlers[opcode], -1, None))
+                else: self.decoded.append((opcode, data, handlers[opcode], static_pushes, a_effective(static_a, static_pushes, data)))
+                static_a = 0
+                static_pushes = 0
+
+    # Same thing, but for code running from RAM or I/O (which can change under us).
+    def decode_slow(self, ip):
+        inst = self.get(ip)
+        # Fetching from Nand gives a negative number, which doesn't decode to any instruction. It still works
+        # out the final A (so too many pushes still raises) and clears the pushes, but does nothing else.
+        if inst < 0: return (inst >> 6, inst & 0x3F, self.exec_nothing, -1, None)
+        handlers = (self.exec_asmovd, self.exec_amovd, self.exec_dmovas, self.exec_push)
+        return (inst >> 6, inst & 0x3F, handlers[inst >> 6], None if inst >> 6 == Opcodes.PushA else -1, None)
 
     # Calculate A given the current instruction and sign extension.
     def final_a(self, inst_a):
-        calc_a = (self.a | inst_a) & 0xFFFF
-        # I refuse to be smarter than this.
-        if self.num_pushes == 0:
-            if calc_a & 0x0020: return calc_a | (~0x3F & 0xFFFF)
-            else: return calc_a & 0x3F
-        elif self.num_pushes == 1:
-            if calc_a & 0x0800: return calc_a | (~0xFFF & 0xFFFF)
-            else: return calc_a & 0xFFF
-        elif self.num_pushes == 2:
-            return calc_a
-        else:
-            raise RuntimeWarning("Too many pushes in a row")
+        return a_effective(self.a, self.num_pushes, inst_a)
 
     # Manipulates one of the counter registers.
     def counter_up(self, base_addr):
@@ -91,114 +447,577 @@ class PongoCore():
     # Gets a byte from system memory.
     def get(self, addr):
         addr &= 0xFFFF
-        if addr < 16384:
-            if addr == Regs.Nand:
-                return ~(self.ram[Regs.IndiLo] & self.ram[Regs.IndiHi])
-            elif addr == Regs.Flow:
-                return (self.ram[Regs.IndiLo] >> 1) | (0x80 if self.ram[Regs.IndiLo] & 0x1 else 0x0)
-            else:
-                return self.ram[addr] & 0xFF
-
-        elif addr < 32768:
-            return self.io_handler(addr - 16384) & 0xFF
+        page = self.read_pages[addr >> 8]
+        if page is None:
+            if addr > Regs.Flow or addr < Regs.Nand: return self.memory[addr]
+            return self.read_registers(addr)
+        return page(addr)
 
-        elif addr < 65536:
-            return self.rom[addr - 32768] & 0xFF
-
-        else:
-            raise RuntimeWarning("Read out of bounds")
+    # Looks at a byte without the access counting for anything: devices don't see a read and watches
+    # don't go off. I/O can only be looked at like that through a DeviceBus.
+    def peek(self, addr):
+        addr &= 0xFFFF
+        if not 0x4000 <= addr < 0x8000: return self.memory[addr]
+        if not isinstance(self.io_handler, DeviceBus): raise ValueError("I/O can't be peeked without a DeviceBus")
+        return self.io_handler.peek(addr - 0x4000) & 0xFF
 
     # Sets a byte in system memory.
     def set(self, addr, data):
         addr &= 0xFFFF
-        data &= 0xFF
-        if addr < 16384:
-            # We can just ignore writes to Nand.
-            self.ram[addr] = data
-
-            if addr == Regs.Flow:
-                if (data & FlowLines.SixteenWide): self.next_sixteen = True
-                if (data & FlowLines.InhibitIfZero): self.next_inhibit = True
-                if (data & FlowLines.LoadIndirect): self.next_load_indirect = True
-                if (data & FlowLines.StoreIndirect): self.next_store_indirect = True
-
-                if (data & FlowLines.LoopDown): self.counter_down(Regs.LoopLo)
-                if (data & FlowLines.IndirectUp): self.counter_up(Regs.IndiLo)
-                if (data & FlowLines.IndirectDown): self.counter_down(Regs.IndiLo)
-                
-        elif addr < 32768:
-            self.io_handler((addr - 16384) & 0xFFFF, data)
+        page = self.write_pages[addr >> 8]
+        if page is None:
+            if addr != Regs.Flow: self.memory[addr] = data & 0xFF
+            else: self.write_registers(addr, data & 0xFF)
+        else: page(addr, data & 0xFF)
+
+    # Page handlers for the slow parts of memory. The register ones only see Nand and Flow, unless
+    # there's a watch on the zero page.
+    def read_registers(self, addr):
+        if addr == Regs.Nand:
+            return ~(self.ram[Regs.IndiLo] & self.ram[Regs.IndiHi])
+        elif addr == Regs.Flow:
+            return (self.ram[Regs.IndiLo] >> 1) | (0x80 if self.ram[Regs.IndiLo] & 0x1 else 0x0)
+        else:
+            return self.ram[addr]
+
+    def write_registers(self, addr, data):
+        # We can just ignore writes to Nand.
+        self.ram[addr] = data
+
+        if addr == Regs.Flow:
+            action = FLOW_ACTIONS[data]
+            if action is not None: action(self)
+
+    def read_io(self, addr):
+        return self.io_read(addr - 16384) & 0xFF
 
+    def write_io(self, addr, data):
+        self.io_write(addr - 16384, data)
+
+    # Bulk writes into the I/O window, for the loop idioms.
+    def write_io_block(self, offset, data):
+        if isinstance(self.io_handler, DeviceBus):
+            self.io_handler.write_block(offset, data)
+        else:
+            for i in range(len(data)): self.io_write(offset + i, data[i])
+
+    def write_rom(self, addr, data):
+        raise RuntimeWarning("Write out of bounds")
+
+    # Copies a run of bytes the way a byte-at-a-time loop would, for the loop idioms. Only handles the easy
+    # cases: no overlap, nothing touching the registers, reads from plain RAM or ROM, writes to plain RAM or I/O.
+    # Returns False (and does nothing) otherwise.
+    def bulk_copy(self, src, dest, count):
+        if not (0x10 <= src and src + count <= 0x4000) and not (0x8000 <= src and src + count <= 0x8000 + len(self.rom)):
+            return False
+        data = self.memory[src:src + count]
+
+        if 0x10 <= dest and dest + count <= 0x4000:
+            if src < dest + count and dest < src + count: return False
+            self.memory[dest:dest + count] = data
+        elif 0x4000 <= dest and dest + count <= 0x8000:
+            self.write_io_block(dest - 0x4000, data)
         else:
-            raise RuntimeWarning("Write out of bounds")
+            return False
+
+        return True
+
+    def bulk_fill(self, dest, value, count):
+        if 0x10 <= dest and dest + count <= 0x4000:
+            self.memory[dest:dest + count] = bytes([value]) * count
+        elif 0x4000 <= dest and dest + count <= 0x8000:
+            self.write_io_block(dest - 0x4000, bytes([value]) * count)
+        else:
+            return False
+
+        return True
+
+    # Instruction handlers. Pushes take the 6-bit data field of the instruction, everything else takes the
+    # final (sign extended) A.
+    def exec_push(self, this_data):
+        # The hardware doesn't shift, but rather flip-flops between high chunks.
+        side = self.num_pushes & 1
+        self.a = (self.a & PUSH_KEEP[side]) | PUSH_CHUNKS[side][this_data]
+        self.num_pushes += 1
+
+    def exec_nothing(self, this_a):
+        self.num_pushes = 0
+
+    def exec_amovd(self, this_a):
+        self.d = this_a
+        self.num_pushes = 0
+
+    def exec_asmovd(self, this_address):
+        # Also note the order of ops here: need to inhibit looking at this flag during flow writes
+        do_six = self.next_sixteen
+
+        if self.next_load_indirect:
+            this_address = (self.get(Regs.IndiHi) << 8 | self.get(Regs.IndiLo))
+            self.next_load_indirect = False
+
+        new_data = self.get(this_address)
+        if do_six: new_data = (self.get(this_address + 1) << 8 | new_data)
+        # self.next_sixteen = False  # To enable wide load/stores in the same instruction
+        self.d = new_data
+
+        self.num_pushes = 0  # resetting every time reflects the circuit as built - could change
+
+    def exec_dmovas(self, this_address):
+        do_six = self.next_sixteen
+        should_move = True
+
+        if self.next_inhibit:
+            this_loop = self.get(Regs.LoopHi) << 8 | self.get(Regs.LoopLo)
+            if this_loop == 0: should_move = False
+            self.next_inhibit = False
+
+        if should_move:
+            if self.next_store_indirect:
+                this_address = (self.get(Regs.IndiHi) << 8 | self.get(Regs.IndiLo))
+                self.next_store_indirect = False
+
+            self.set(this_address, self.d)
+            if do_six:
+                self.set(this_address + 1, self.d >> 8)
+       
+        # What a confusing mess. For your reference later when you've forgotten the details
+        # * Loading wide should *not* clear the flag - never a good reason to load wide and store narrow
+        # * Storing wide should *always* clear the flag - prevents dangling wide writes after a loop
+        # This behavior was inverted before when the test was "inhibit if not zero" - we needed the dangling
+        # wide to support a guaranteed jump after the failing jump out of a loop
+        # Now loops happen with one jump so it needs to clear always
+        # Remember
+        if do_six: self.next_sixteen = False
+
+        self.num_pushes = 0
 
     # Process a single instruction.
     def spin(self):
-        this_ip = self.get(Regs.IpHi) << 8 | self.get(Regs.IpLo)
-        this_inst = self.get(this_ip)
-        this_opcode = this_inst >> 6
-        this_data = this_inst & 0x3F
-        
+        self.hit = None
+        ram = self.ram
+        this_ip = ram[Regs.IpHi] << 8 | ram[Regs.IpLo]
+
+        # ROM is predecoded; anything else has to be fetched the long way.
+        if this_ip >= 0x8000 and this_ip - 0x8000 < len(self.decoded):
+            this_opcode, this_data, handler, static_pushes, static_a = self.decoded[this_ip - 0x8000]
+        else:
+            this_opcode, this_data, handler, static_pushes, static_a = self.decode_slow(this_ip)
+
         self.counter_up(Regs.IpLo)
+        self.cycles += 1
+
+        if static_pushes == self.num_pushes: handler(static_a)
+        elif static_pushes is None: handler(this_data)
+        else: handler(self.final_a(this_data))
+
+        self.a &= 0xFFFF
+        self.d &= 0xFFFF
+
+    # Packs the pending flow flags into a small int, for keying compiled blocks.
+    def flow_state(self):
+        return self.next_sixteen | self.next_inhibit << 1 | self.next_load_indirect << 2 | self.next_store_indirect << 3
+
+    # Turn the run of ROM starting at ip into a Python function. Returns (function, max cycles, loop idiom).
+    def compile_block(self, ip, flow_state):
+        builder = BlockBuilder(self, ip, flow_state)
+        # Loops we know how to do in one go only ever start clean.
+        idiom = LoopIdiom.match(self.rom, ip) if flow_state == 0 else None
+        return (builder.build(), builder.count, idiom)
 
-        if this_opcode == Opcodes.PushA:
-            # The hardware doesn't shift, but rather flip-flops between high chunks.
-            if self.num_pushes % 2 == 0:
-                self.a = (self.a & ~0xFC0) | (this_data << 6)
+    # Run until the cycle counter reaches the given count. Same results as calling spin() that many times,
+    # but uses compiled blocks wherever it can. Optionally bails out early whenever stop() is true.
+    def run_until(self, cycles, stop=None):
+        resume_ip = self.resume_from_hit()
+        if self.breakpoints or self.read_watches or self.write_watches: return self.run_debug(cycles, stop, resume_ip)
+        blocks = self.blocks
+        rom_end = 0x8000 + len(self.decoded)
+
+        while self.cycles < cycles:
+            if stop is not None and stop(): break
+
+            ram = self.ram
+            this_ip = ram[Regs.IpHi] << 8 | ram[Regs.IpLo]
+
+            # Blocks only start on a clean A, and we don't compile RAM (it might change).
+            if self.num_pushes == 0 and 0x8000 <= this_ip < rom_end:
+                key = this_ip | self.flow_state() << 16
+                block = blocks.get(key)
+                if block is None:
+                    block = self.compile_block(this_ip, key >> 16)
+                    blocks[key] = block
+
+                # Skip ahead through memcpy/memset loops if we're sitting at the top of one.
+                if block[2] is not None:
+                    skipped = block[2].run(self, cycles - self.cycles)
+                    if skipped:
+                        self.cycles += skipped
+                        continue
+
+                # Don't run past the requested cycle - step the last few instead.
+                if self.cycles + block[1] <= cycles:
+                    # Not +=, which would read the count before a block ending in a handler adds to it.
+                    ran = block[0](self)
+                    self.cycles += ran
+                    continue
+
+            self.spin()
+
+
+    # Forget whatever stopped the last run. If it was a breakpoint, returns its address: if we're still
+    # sitting on it, it's let go once so there's a way past.
+    def resume_from_hit(self):
+        hit = self.hit
+        self.hit = None
+        return hit[1] if hit is not None and hit[0] == "break" else None
+
+    # Whether running from ip should stop at a breakpoint first. Notes the hit if so.
+    def at_breakpoint(self, ip):
+        if ip not in self.breakpoints: return False
+        condition = self.breakpoints[ip]
+        if condition is not None and not condition(self): return False
+        self.hit = ("break", ip)
+        return True
+
+    # The same as run_until, one instruction at a time, stopping at breakpoints and after watched accesses.
+    def run_debug(self, cycles, stop=None, resume_ip=None):
+        while self.cycles < cycles:
+            if stop is not None and stop(): break
+
+            ram = self.ram
+            this_ip = ram[Regs.IpHi] << 8 | ram[Regs.IpLo]
+            if this_ip != resume_ip and self.at_breakpoint(this_ip): break
+            resume_ip = None
+
+            self.spin()
+            if self.hit is not None: break
+
+    # Move the cycle counter ahead without running anything, e.g. when the guest is waiting for the next
+    # frame and there's no point simulating the wait. Skipped cycles are counted separately.
+    def skip_to(self, cycles):
+        if cycles > self.cycles:
+            self.skipped_cycles += cycles - self.cycles
+            self.cycles = cycles
+
+
+# The recompiler. Walks a straight-line run of ROM and writes Python source that does the same thing,
+# with everything that can be known ahead of time (pushes, sign extension, addresses) baked in.
+# A run ends at anything we can't (or shouldn't) predict: Ip and Flow writes, I/O, inhibited moves.
+# Those get handed back to the regular instruction handlers. A block returns how many cycles it ran,
+# apart from one that ends in a handler: that adds its cycles to the core itself and returns 0.
+# Note: this assumes the low six bits of A are clear on entry, which is true unless you've been poking at it.
+MAX_BLOCK_LENGTH = 256
+
+class BlockBuilder():
+    def __init__(self, core, ip, flow_state):
+        self.core = core
+        self.entry = ip
+        self.pc = ip
+        self.count = 0
+        self.lines = []
+
+        # What we know about the machine at this point in the block.
+        self.pushes = 0
+        self.a_mask = 0  # bits of A set by pushes in this block
+        self.a_val = 0
+        self.six = bool(flow_state & 0x1)
+        self.inhibit = bool(flow_state & 0x2)
+        self.load_ind = bool(flow_state & 0x4)
+        self.store_ind = bool(flow_state & 0x8)
+
+    def emit(self, line, depth=1):
+        self.lines.append("    " * depth + line)
+
+    # Write our idea of the machine state back to the core.
+    def sync(self, ip, depth=1):
+        self.emit(f"ram[0] = {ip & 0xFF}; ram[1] = {ip >> 8}", depth)
+        if self.a_mask: self.emit(f"core.a = core.a & {~self.a_mask & 0xFFFF} | {self.a_val}", depth)
+        self.emit(f"core.d = d; core.num_pushes = {self.pushes}", depth)
+        self.emit(f"core.next_sixteen = {self.six}; core.next_inhibit = {self.inhibit}", depth)
+        self.emit(f"core.next_load_indirect = {self.load_ind}; core.next_store_indirect = {self.store_ind}", depth)
+
+    # Give up and let the interpreter run this instruction, then leave the block. The cycles go on
+    # first, so they're the same as spin()'s if the instruction faults.
+    def bail(self, opcode, data, next_ip, depth=1):
+        handler = ("exec_asmovd", "exec_amovd", "exec_dmovas", "exec_push")[opcode]
+        self.sync(next_ip, depth)
+        self.emit(f"core.cycles += {self.count + 1}", depth)
+        self.emit(f"core.{handler}({a_effective(self.a_val, self.pushes, data)})", depth)
+        self.emit("core.a &= 0xFFFF; core.d &= 0xFFFF", depth)
+        self.emit("return 0", depth)
+
+    # Python expression for a static read, or None if it can't be done inside a block.
+    def read_expr(self, addr, next_ip):
+        addr &= 0xFFFF
+        if addr == Regs.IpLo: return str(next_ip & 0xFF)
+        elif addr == Regs.IpHi: return str(next_ip >> 8)
+        elif addr == Regs.Nand or addr == Regs.Flow: return f"get({addr})"
+        elif addr < 0x4000: return f"ram[{addr}]"
+        elif addr < 0x8000: return None
+        elif addr - 0x8000 < len(self.core.rom): return str(self.core.rom[addr - 0x8000] & 0xFF)
+        else: return None
+
+    # Whether a static write is just a plain store into RAM.
+    @staticmethod
+    def plain_write(addr):
+        addr &= 0xFFFF
+        return addr >= Regs.LoopLo and addr != Regs.Flow and addr < 0x4000
+
+    def build_push(self, data):
+        self.a_mask |= ~PUSH_KEEP[self.pushes & 1] & 0xFFFF
+        self.a_val = push_a(self.a_val, self.pushes, data)
+        self.pushes += 1
+
+    # Each of these returns True if the instruction ended the block.
+    def build_amovd(self, data, next_ip):
+        self.emit(f"d = {a_effective(self.a_val, self.pushes, data)}")
+        self.pushes = 0
+        return False
+
+    def build_asmovd(self, data, next_ip):
+        if self.load_ind:
+            last = 0x3FFE if self.six else 0x3FFF
+            self.emit("addr = ram[5] << 8 | ram[4]")
+            self.emit(f"if 8 <= addr <= {last}:")
+            self.emit("d = ram[addr + 1] << 8 | ram[addr]" if self.six else "d = ram[addr]", 2)
+            self.emit("else:")
+            self.bail(Opcodes.AsMovD, data, next_ip, 2)
+            self.load_ind = False
+
+        else:
+            addr = a_effective(self.a_val, self.pushes, data)
+            low = self.read_expr(addr, next_ip)
+            high = self.read_expr(addr + 1, next_ip) if self.six else "0"
+            if low is None or high is None:
+                self.bail(Opcodes.AsMovD, data, next_ip)
+                return True
+
+            self.emit(f"d = ({high} << 8 | {low}) & 0xFFFF" if self.six else f"d = {low} & 0xFFFF")
+
+        self.pushes = 0
+        return False
+
+    def build_dmovas(self, data, next_ip):
+        # Inhibited moves are almost always jumps anyway.
+        if self.inhibit:
+            self.bail(Opcodes.DmovAs, data, next_ip)
+            return True
+
+        if self.store_ind:
+            last = 0x3FFE if self.six else 0x3FFF
+            self.emit("addr = ram[5] << 8 | ram[4]")
+            self.emit(f"if 8 <= addr <= {last}:")
+            self.emit("ram[addr] = d & 0xFF", 2)
+            if self.six: self.emit("ram[addr + 1] = d >> 8", 2)
+            self.emit("else:")
+            self.bail(Opcodes.DmovAs, data, next_ip, 2)
+            self.store_ind = False
+
+        else:
+            addr = a_effective(self.a_val, self.pushes, data)
+            if not self.plain_write(addr) or (self.six and not self.plain_write(addr + 1)):
+                self.bail(Opcodes.DmovAs, data, next_ip)
+                return True
+
+            self.emit(f"ram[{addr}] = d & 0xFF")
+            if self.six: self.emit(f"ram[{(addr + 1) & 0xFFFF}] = d >> 8")
+
+        # Same wide rule as the interpreter: storing always clears it.
+        self.six = False
+        self.pushes = 0
+        return False
+
+    def build(self):
+        decoded = self.core.decoded
+        builders = (self.build_asmovd, self.build_amovd, self.build_dmovas)
+        ended = False
+
+        while self.count < MAX_BLOCK_LENGTH:
+            index = self.pc - 0x8000
+            if index < 0 or index >= len(decoded): break
+
+            opcode, data = decoded[index][:2]
+            next_ip = (self.pc + 1) & 0xFFFF
+
+            if opcode == Opcodes.PushA:
+                self.build_push(data)
             else:
-                self.a = (self.a & ~0xF000) | (this_data << 12)
+                # Let the interpreter complain about this one.
+                if self.pushes > 2: break
+                ended = builders[opcode](data, next_ip)
+
+            self.count += 1
+            self.pc = next_ip
+            if ended: break
+
+        if not ended:
+            self.sync(self.pc)
+            self.emit(f"return {self.count}")
+
+        src = "def block(core):\n    ram = core.ram\n    get = core.get\n    d = core.d\n" + "\n".join(self.lines) + "\n"
+        scope = {}
+        exec(compile(src, f"<block ${self.entry:04x}>", "exec"), scope)
+        return scope["block"]
 
-            self.num_pushes += 1
+# Folds pushes into the instruction that uses them, like the assembler would have written it.
+# Returns a list of (opcode, value, length in bytes), or None if we fall off the end of ROM.
+def fold_ops(rom, addr, count):
+    ops = []
+    index = addr - 0x8000
+    while len(ops) < count:
+        a = 0
+        pushes = 0
+        start = index
+        while True:
+            if index < 0 or index >= len(rom) or pushes > 2: return None
+            inst = rom[index] & 0xFF
+            index += 1
+            if inst >> 6 != Opcodes.PushA: break
 
-        elif this_opcode == Opcodes.AMovD:
-            self.d = self.final_a(this_data)
-            self.num_pushes = 0
+            a = push_a(a, pushes, inst & 0x3F)
+            pushes += 1
+
+        ops.append((inst >> 6, a_effective(a, pushes, inst & 0x3F), index - start))
+    return ops
+
+
+# Loops from environment.lisp that can be run in one go. These are the loop-for bodies, which start
+# right after Loop gets loaded, and end with the loop-- and jump-if back to the top.
+# Note on naming: memcpy copies from TmpD to TmpB (the macro's arguments are backwards).
+MEMCPY_BODY = [
+    (Opcodes.AMovD, FlowLines.SixteenWide), (Opcodes.DmovAs, Regs.Flow),
+    (Opcodes.AsMovD, 0xE), (Opcodes.DmovAs, Regs.IndiLo),
+    (Opcodes.AMovD, FlowLines.LoadIndirect), (Opcodes.DmovAs, Regs.Flow),
+    (Opcodes.AsMovD, Regs.IndiLo), (Opcodes.DmovAs, 0xB),
+    (Opcodes.AMovD, FlowLines.IndirectUp), (Opcodes.DmovAs, Regs.Flow),
+    (Opcodes.AMovD, FlowLines.SixteenWide), (Opcodes.DmovAs, Regs.Flow),
+    (Opcodes.AsMovD, Regs.IndiLo), (Opcodes.DmovAs, 0xE),
+    (Opcodes.AMovD, FlowLines.SixteenWide), (Opcodes.DmovAs, Regs.Flow),
+    (Opcodes.AsMovD, 0xC), (Opcodes.DmovAs, Regs.IndiLo),
+    (Opcodes.AMovD, FlowLines.StoreIndirect), (Opcodes.DmovAs, Regs.Flow),
+    (Opcodes.AsMovD, 0xB), (Opcodes.DmovAs, Regs.IndiLo),
+    (Opcodes.AMovD, FlowLines.IndirectUp), (Opcodes.DmovAs, Regs.Flow),
+    (Opcodes.AMovD, FlowLines.SixteenWide), (Opcodes.DmovAs, Regs.Flow),
+    (Opcodes.AsMovD, Regs.IndiLo), (Opcodes.DmovAs, 0xC),
+]
+
+# The value load (second entry) can be anything.
+MEMSET_BODY = [
+    (Opcodes.AMovD, FlowLines.StoreIndirect), (Opcodes.DmovAs, Regs.Flow),
+    None, (Opcodes.DmovAs, Regs.IndiLo),
+    (Opcodes.AMovD, FlowLines.IndirectUp), (Opcodes.DmovAs, Regs.Flow),
+]
+
+# loop-- and jump-if. The jump target gets checked separately.
+LOOP_TAIL = [
+    (Opcodes.AMovD, FlowLines.LoopDown), (Opcodes.DmovAs, Regs.Flow),
+    (Opcodes.AMovD, FlowLines.InhibitIfZero | FlowLines.SixteenWide), (Opcodes.DmovAs, Regs.Flow),
+    None, (Opcodes.DmovAs, Regs.IpLo),
+]
+
+# A jump to itself, which is what halt compiles to. Nothing changes from one trip to the next,
+# so any number of trips can be skipped.
+IDLE_BODY = [
+    (Opcodes.AMovD, FlowLines.SixteenWide), (Opcodes.DmovAs, Regs.Flow),
+    None, (Opcodes.DmovAs, Regs.IpLo),
+]
+
+LOOP_IDIOMS = (
+    ("memcpy", MEMCPY_BODY + LOOP_TAIL),
+    ("memset", MEMSET_BODY + LOOP_TAIL),
+    ("idle", IDLE_BODY),
+)
+
+class LoopIdiom():
+    def __init__(self, kind, entry, length, jump_a, flow, value_op=None):
+        self.kind = kind
+        self.entry = entry
+        self.length = length  # cycles per trip around the loop
+        self.jump_a = jump_a  # what A looks like after the jump back
+        self.flow = flow      # last thing written to Flow on the way round
+        self.value_op = value_op
+
+    # Check whether the loop at addr is one of ours. Returns a LoopIdiom or None.
+    @classmethod
+    def match(cls, rom, addr):
+        for kind, pattern in LOOP_IDIOMS:
+            ops = fold_ops(rom, addr, len(pattern))
+            if ops is None: continue
+            if any(want is not None and want != op[:2] for want, op in zip(pattern, ops)): continue
+
+            # Jump back to the top, and it has to be a full 16-bit push. The store to Ip after it can't
+            # push anything, or A wouldn't be left the way jump_a says.
+            jump = ops[-2]
+            if jump[0] != Opcodes.AMovD or jump[1] != addr or jump[2] != 3: continue
+            if ops[-1][2] != 1: continue
+
+            value_op = None
+            if kind == "memset":
+                value_op = ops[2]
+                if value_op[0] == Opcodes.DmovAs: continue
+
+            length = sum(op[2] for op in ops)
+            jump_start = addr - 0x8000 + length - 4
+            jump_a = ((rom[jump_start] & 0x3F) << 6) | (((rom[jump_start + 1] & 0x3F) << 12) & 0xFFFF)
+            return cls(kind, addr, length, jump_a, pattern[-4][1], value_op)
+
+        return None
+
+    # Run as many trips around the loop as fit in the budget, always leaving the last one for
+    # the interpreter. Returns the number of cycles taken, or 0 if we couldn't help.
+    def run(self, core, budget):
+        ram = core.ram
+
+        # Idle loops never end, so there's no last trip to worry about. Nothing really ran, so these
+        # count as skipped too, same as skip_to().
+        if self.kind == "idle":
+            trips = budget // self.length
+            if trips <= 0: return 0
+            core.skipped_cycles += trips * self.length
+            return self.finish(core, trips)
+
+        remaining = ram[Regs.LoopHi] << 8 | ram[Regs.LoopLo]
+        if remaining == 0: remaining = 0x10000
+        trips = min(remaining - 1, budget // self.length)
+        if trips <= 0: return 0
+
+        if self.kind == "memcpy":
+            src = ram[0xF] << 8 | ram[0xE]
+            dest = ram[0xD] << 8 | ram[0xC]
+            if not core.bulk_copy(src, dest, trips): return 0
+
+            last = core.get(src + trips - 1)
+            src = (src + trips) & 0xFFFF
+            dest = (dest + trips) & 0xFFFF
+            ram[0xB] = last
+            ram[0xE] = src & 0xFF
+            ram[0xF] = src >> 8
+            ram[0xC] = dest & 0xFF
+            ram[0xD] = dest >> 8
 
         else:
-            this_address = self.final_a(this_data)
-            # Also note the order of ops here: need to inhibit looking at this flag during flow writes
-            do_six = self.next_sixteen
-
-            if this_opcode == Opcodes.AsMovD:
-                if self.next_load_indirect:
-                    this_address = (self.get(Regs.IndiHi) << 8 | self.get(Regs.IndiLo))
-                    self.next_load_indirect = False
-
-                new_data = self.get(this_address)
-                if do_six: new_data = (self.get(this_address + 1) << 8 | new_data)
-                # self.next_sixteen = False  # To enable wide load/stores in the same instruction
-                self.d = new_data
-            
-            elif this_opcode == Opcodes.DmovAs:
-                should_move = True
-
-                if self.next_inhibit:
-                    this_loop = self.get(Regs.LoopHi) << 8 | self.get(Regs.LoopLo)
-                    if this_loop == 0: should_move = False
-                    self.next_inhibit = False
-
-                if should_move:
-                    if self.next_store_indirect:
-                        this_address = (self.get(Regs.IndiHi) << 8 | self.get(Regs.IndiLo))
-                        self.next_store_indirect = False
-
-                    self.set(this_address, self.d)
-                    if do_six:
-                        self.set(this_address + 1, self.d >> 8)
-               
-                # What a confusing mess. For your reference later when you've forgotten the details
-                # * Loading wide should *not* clear the flag - never a good reason to load wide and store narrow
-                # * Storing wide should *always* clear the flag - prevents dangling wide writes after a loop
-                # This behavior was inverted before when the test was "inhibit if not zero" - we needed the dangling
-                # wide to support a guaranteed jump after the failing jump out of a loop
-                # Now loops happen with one jump so it needs to clear always
-                # Remember
-                if do_six: self.next_sixteen = False
-
-            self.num_pushes = 0  # resetting every time reflects the circuit as built - could change
+            dest = ram[Regs.IndiHi] << 8 | ram[Regs.IndiLo]
+            opcode, value, _ = self.value_op
+            if opcode == Opcodes.AsMovD:
+                # Only if the value can't change under us.
+                if not (0x10 <= value < 0x4000 or 0x8000 <= value < 0x8000 + len(core.rom)): return 0
+                if dest <= value < dest + trips: return 0
+                value = core.get(value)
+            if not core.bulk_fill(dest, value & 0xFF, trips): return 0
+            dest = (dest + trips) & 0xFFFF
 
-        self.a &= 0xFFFF
-        self.d &= 0xFFFF
+        ram[Regs.IndiLo] = dest & 0xFF
+        ram[Regs.IndiHi] = dest >> 8
+        remaining -= trips
+        ram[Regs.LoopLo] = remaining & 0xFF
+        ram[Regs.LoopHi] = remaining >> 8
+        return self.finish(core, trips)
+
+    # Everything that ends up the same after any jump back to the top.
+    def finish(self, core, trips):
+        core.ram[Regs.Flow] = self.flow
+        core.a = (core.a & 0x3F) | self.jump_a
+        core.d = self.entry
+        return trips * self.length
 
 # A note to you: on inhibit ordering
 # Initially, it was inhibit > 0, and 16w was preserved on failed D>A*
@@ -211,6 +1030,7 @@ class PongoCore():
 # Note to self: you could do something terrible and load Ip from RAM, adding three cycles to every inst
 
 # Memory map:
+# $0000 - $0007  Registers
 # $0008 - $3FFF  RAM
 # $4000 - $47FF  Display
 # $8000 - $FFFF  ROM (reset vector is $8000)
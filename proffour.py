@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import bisect
+import argparse
+from collections import defaultdict
+
+# Where the cycles go. Profiling counts how many times each address runs, keeps those counts apart
+# by call stack, and notes how many cycles each guest frame took (from one wait-for-frame to the
+# next). Recording works with raw addresses; turning them into labels happens afterwards, with the
+# symbol map impede writes next to the binary:
+#   python emufour.py pfpong.bin --profile profile.json
+#   python proffour.py profile.json --folded pfpong.folded
+# The folded file is what flamegraph.pl (or speedscope, etc.) takes.
+#
+# There's no call instruction, so calls are guessed from how call-routine does them: the return
+# address goes into TmpD, then a jump. Any jump made with TmpD pointing just past the jump is a
+# call, and a jump back to where a call on the stack would return to is a return.
+
+MAX_DEPTH = 64
+
+class Profiler():
+    def __init__(self, path=None, budget=None, rom=None):
+        self.path = path
+        self.budget = budget
+        self.rom = os.path.abspath(rom) if rom is not None else None
+
+        # Stack (a tuple of (call site, target) pairs) -> address -> executions.
+        self.stacks = defaultdict(lambda: defaultdict(int))
+        self.stack = ()
+        self.counts = self.stacks[self.stack]
+
+        self.frames = []
+        self.frame_cycles = 0
+
+    # Like PongoCore.run_until, but one instruction at a time so each one gets counted. Stops at
+    # breakpoints and watches the same way. A stop counts as the end of a guest frame, which is what
+    # the emulator uses it for.
+    def run_until(self, core, cycles, stop=None):
+        resume_ip = core.resume_from_hit()
+        ram = core.ram
+        while core.cycles < cycles and not (stop is not None and stop()):
+            ip = ram[0] | ram[1] << 8
+            if core.breakpoints and ip != resume_ip and core.at_breakpoint(ip): break
+            resume_ip = None
+            self.counts[ip] += 1
+            begin_cycles = core.cycles
+            core.spin()
+            self.frame_cycles += core.cycles - begin_cycles
+
+            next_ip = ram[0] | ram[1] << 8
+            if next_ip != ip + 1: self.jumped(ip, next_ip, ram[0xE] | ram[0xF] << 8)
+            if stop is not None and stop(): self.end_frame()
+            if core.hit is not None: break
+
+    def jumped(self, ip, target, tmpd):
+        stack = self.stack
+        if tmpd == ip + 1:
+            if len(stack) < MAX_DEPTH: stack = stack + ((ip, target),)
+        else:
+            # Returns can skip levels, if a routine jumped somewhere else instead of returning.
+            for depth in range(len(stack) - 1, -1, -1):
+                if stack[depth][0] + 1 == target:
+                    stack = stack[:depth]
+                    break
+        if stack is not self.stack:
+            self.stack = stack
+            self.counts = self.stacks[stack]
+
+    def end_frame(self):
+        self.frames.append(self.frame_cycles)
+        self.frame_cycles = 0
+
+    def total(self):
+        return sum(sum(counts.values()) for counts in self.stacks.values())
+
+    def save(self, path):
+        with open(path, "w") as outfile:
+            json.dump({
+                "rom": self.rom, "budget": self.budget, "frames": self.frames,
+                "stacks": [{"stack": [list(call) for call in stack], "counts": sorted(counts.items())}
+                           for stack, counts in self.stacks.items() if counts],
+            }, outfile)
+
+    def close(self):
+        if self.path is not None:
+            self.save(self.path)
+            self.path = None
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as infile:
+            contents = json.load(infile)
+        profiler = cls(budget=contents["budget"])
+        profiler.rom = contents["rom"]
+        profiler.frames = contents["frames"]
+        for entry in contents["stacks"]:
+            counts = profiler.stacks[tuple(tuple(call) for call in entry["stack"])]
+            for addr, count in entry["counts"]: counts[addr] += count
+        return profiler
+
+
+# The symbol map from impede: a line per label, hex address then name.
+class Symbols():
+    def __init__(self, symbols=()):
+        self.addrs = [addr for addr, name in symbols]
+        self.names = [name for addr, name in symbols]
+
+    @classmethod
+    def load(cls, path):
+        symbols = []
+        with open(path) as infile:
+            for line in infile:
+                addr, _, name = line.strip().partition(" ")
+                if name: symbols.append((int(addr, 16), name))
+        symbols.sort(key=lambda symbol: symbol[0])
+        return cls(symbols)
+
+    # Without a map, the places calls went to are the next best thing.
+    @classmethod
+    def from_calls(cls, profiler):
+        targets = {target for stack in profiler.stacks for site, target in stack}
+        return cls([(addr, f"${addr:04x}") for addr in sorted(targets | {0x8000})])
+
+    # The closest label at or before addr. Where several labels share an address, the last one in the map wins.
+    def name(self, addr):
+        index = bisect.bisect_right(self.addrs, addr) - 1
+        return self.names[index] if index >= 0 else f"${addr:04x}"
+
+    def describe(self, addr):
+        index = bisect.bisect_right(self.addrs, addr) - 1
+        if index < 0: return f"${addr:04x}"
+        offset = addr - self.addrs[index]
+        return f"${addr:04x} {self.names[index]}" + (f"+{offset}" if offset else "")
+
+# The labels an address is under when it runs with the given stack, outermost first: where each call
+# came from and where it went, then the address itself. Runs of the same label are one label.
+def fold(symbols, stack, addr):
+    path = []
+    for site, target in stack:
+        path.append(symbols.name(site))
+        path.append(symbols.name(target))
+    path.append(symbols.name(addr))
+    return [name for i, name in enumerate(path) if i == 0 or name != path[i - 1]]
+
+def write_folded(profiler, symbols, path):
+    folded = defaultdict(int)
+    for stack, counts in profiler.stacks.items():
+        for addr, count in counts.items():
+            folded[";".join(fold(symbols, stack, addr))] += count
+    with open(path, "w") as outfile:
+        for line, count in sorted(folded.items()):
+            outfile.write(f"{line} {count}\n")
+
+# Per label: self is what ran under that label, total is everything that ran with it anywhere on
+# the folded stack (so a routine's total includes what it called).
+def print_report(profiler, symbols, top=30, addresses=0):
+    total = profiler.total()
+    frames = profiler.frames
+    if not total:
+        print("Nothing was profiled")
+        return
+
+    if frames:
+        print(f"{len(frames)} frames, {min(frames)}/{sum(frames) / len(frames):.0f}/{max(frames)} cycles min/mean/max, "
+              f"worst was frame {frames.index(max(frames))}")
+        if profiler.budget:
+            over = sum(1 for cycles in frames if cycles > profiler.budget)
+            print(f"Budget {profiler.budget} cycles a frame: {over} frames over, peak {max(frames) / profiler.budget:.0%} of it")
+    print(f"{total} instructions profiled")
+    print()
+
+    self_counts = defaultdict(int)
+    total_counts = defaultdict(int)
+    address_counts = defaultdict(int)
+    for stack, counts in profiler.stacks.items():
+        for addr, count in counts.items():
+            path = fold(symbols, stack, addr)
+            self_counts[path[-1]] += count
+            for name in set(path): total_counts[name] += count
+            address_counts[addr] += count
+
+    per_frame = len(frames) or 1
+    print(f"{'self':>10} {'self%':>6} {'total%':>6} {'per frame':>10}  label")
+    for name, count in sorted(self_counts.items(), key=lambda item: -item[1])[:top]:
+        print(f"{count:>10} {count / total:>6.1%} {total_counts[name] / total:>6.1%} {count / per_frame:>10.0f}  {name}")
+
+    if addresses:
+        print()
+        print(f"{'count':>10} {'%':>6}  address")
+        for addr, count in sorted(address_counts.items(), key=lambda item: -item[1])[:addresses]:
+            print(f"{count:>10} {count / total:>6.1%}  {symbols.describe(addr)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pongo v4 profile report")
+    parser.add_argument("profile", help="profile from emufour --profile")
+    parser.add_argument("--symbols", help="symbol map from impede (default: the .sym next to the profiled ROM, if there is one)")
+    parser.add_argument("--folded", help="write folded stacks here, for flamegraph.pl")
+    parser.add_argument("--top", type=int, default=30, help="labels to list (default: 30)")
+    parser.add_argument("--addresses", type=int, default=0, help="also list this many of the hottest addresses")
+    parser.add_argument("--budget", type=int, help="cycles a frame is allowed (default: whatever emufour was running at)")
+    args = parser.parse_args()
+
+    profiler = Profiler.load(args.profile)
+    if args.budget is not None: profiler.budget = args.budget
+
+    symbols_path = args.symbols
+    if symbols_path is None and profiler.rom is not None:
+        symbols_path = os.path.splitext(profiler.rom)[0] + ".sym"
+        if not os.path.exists(symbols_path): symbols_path = None
+    symbols = Symbols.load(symbols_path) if symbols_path is not None else Symbols.from_calls(profiler)
+
+    try:
+        print_report(profiler, symbols, args.top, args.addresses)
+    except BrokenPipeError:
+        sys.exit(0)
+    if args.folded is not None: write_folded(profiler, symbols, args.folded)
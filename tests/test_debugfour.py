@@ -0,0 +1,54 @@
+import os
+
+import debugfour
+import emufour as ef
+import pongofour as pf
+
+ROM = os.path.join(os.path.dirname(__file__), "..", "pfpong.bin")
+
+def test_step_and_read(tmp_path):
+    ef.reset_devices(1)
+    core = pf.PongoCore(ef.load_rom(ROM), ef.build_bus())
+    server = debugfour.DebugServer(str(tmp_path / "debug.sock"))
+    try:
+        # A watch hit from an earlier run isn't this step's.
+        core.add_watchpoint(0xB)
+        core.run_until(100000)
+        assert core.hit is not None
+        core.remove_watchpoint(0xB)
+        assert server.cmd_step(core, {"count": 10})["hit"] is None
+        assert server.hit is None
+
+        # Stepping from a breakpoint gets past it.
+        ip = core.ram[pf.Regs.IpLo] | core.ram[pf.Regs.IpHi] << 8
+        core.add_breakpoint(ip)
+        core.run_until(core.cycles + 1000)
+        assert core.hit == ("break", ip)
+        cycles = core.cycles
+        server.cmd_step(core, {"count": 1})
+        assert core.cycles == cycles + 1
+
+        # A can't be given low bits the core would never see.
+        assert server.cmd_set(core, {"reg": "a", "value": 0x1235})["a"] == 0x1200
+
+        # Reading the RNG over and over gets the same byte, and the guest still gets it next.
+        state = core.io_handler.get_state()
+        first = server.cmd_read(core, {"addr": 0x4404})["data"]
+        assert server.cmd_read(core, {"addr": 0x4400, "length": 8})["data"][8:10] == first
+        assert core.io_handler.get_state() == state
+        assert core.get(0x4404) == int(first, 16)
+    finally:
+        server.close()
+
+# Anything that isn't a list of commands is turned away before it gets near the emulator.
+def test_bad_batches(tmp_path):
+    server = debugfour.DebugServer(str(tmp_path / "debug.sock"))
+    client = debugfour.DebugClient(str(tmp_path / "debug.sock"))
+    try:
+        for batch in (5, "regs", [5], [{"cmd": "regs"}, None]):
+            results = client.batch(batch)
+            assert len(results) == 1 and "error" in results[0]
+        assert server.jobs.empty()
+    finally:
+        client.close()
+        server.close()
@@ -0,0 +1,110 @@
+import os
+import time
+
+import emufour as ef
+import pongofour as pf
+
+ROM = os.path.join(os.path.dirname(__file__), "..", "pfpong.bin")
+
+def wait_for(condition, timeout=120):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.005)
+
+# Play a bit of pfpong on the emulator thread, rewinding partway, then check the recording plays back
+# frame for frame. The title screen polls for a click without waiting for frames, so the first click
+# lands partway through one.
+def test_record_rewind_replay(tmp_path):
+    rom = ef.load_rom(ROM)
+    ef.reset_devices(1)
+    core = pf.PongoCore(rom, ef.build_bus())
+    exchange = ef.FrameExchange()
+    log = ef.InputLog(1)
+    emulator = ef.EmulatorThread(core, ef.FramePacer(turbo=True), exchange, rewinder=ef.Rewinder(core, 100), input_log=log)
+
+    ef.pausing = False
+    ef.printing = False
+    emulator.start()
+    try:
+        wait_for(lambda: core.cycles > 200000)
+        exchange.inputs = (5, 1, 7, 0)
+        wait_for(lambda: len(log) >= 10)
+        exchange.inputs = (20, 0, 3, 0)
+        wait_for(lambda: len(log) >= 20)
+
+        recorded = len(log)
+        for i in range(5): emulator.commands.put("rewind")
+        wait_for(lambda: emulator.commands.empty() and ef.pausing and len(log) < recorded)
+        exchange.inputs = (9, 0, 25, 0)
+        emulator.commands.put("pause")
+        wait_for(lambda: len(log) >= 30)
+    finally:
+        emulator.commands.put("quit")
+        emulator.join()
+
+    assert any(log.changes(frame) for frame in range(len(log)))
+
+    log.save(tmp_path / "input.log")
+    replay = ef.InputLog.load(tmp_path / "input.log")
+    ef.reset_devices(replay.seed)
+    ef.run_headless(rom, frames=len(replay), replay=replay)
+    assert replay.diverged is None
+
+# Turbo runs far ahead of the clock. Turning it off mustn't leave a deadline way off in the future.
+def test_pacer_leaving_turbo():
+    pacer = ef.FramePacer(75, turbo=True)
+    for i in range(2000): pacer.wait()
+    assert pacer.deadline - time.perf_counter_ns() <= pacer.period
+    pacer.set_turbo(False)
+    begin = time.perf_counter()
+    pacer.wait()
+    assert time.perf_counter() - begin < 1
+
+# Printing runs an instruction at a time, and has to stop at breakpoints all the same.
+def test_breakpoint_while_printing(capsys):
+    ef.reset_devices(1)
+    core = pf.PongoCore(ef.load_rom(ROM), ef.build_bus())
+    core.add_breakpoint(0x8011)
+    emulator = ef.EmulatorThread(core, ef.FramePacer(turbo=True), ef.FrameExchange())
+
+    ef.pausing = False
+    ef.printing = True
+    emulator.start()
+    try:
+        wait_for(lambda: ef.pausing)
+    finally:
+        emulator.commands.put("quit")
+        emulator.join()
+    assert core.hit == ("break", 0x8011)
+    assert "Breakpoint at $8011" in capsys.readouterr().out
+
+# A viewer whose mouse moves (and clicks) as the guest runs, whether or not a frame's finished.
+class MovingViewer(ef.FrameExchange):
+    def __init__(self, core):
+        super().__init__()
+        self.core = core
+
+    @property
+    def inputs(self):
+        cycles = self.core.cycles
+        return (cycles // 50000 % 32, 1 if 300000 < cycles < 400000 else 0, cycles // 70000 % 32, 0)
+
+    @inputs.setter
+    def inputs(self, value):
+        pass
+
+# Headless runs record what viewers did too, and the recording plays back the same.
+def test_headless_record_replay():
+    rom = ef.load_rom(ROM)
+    ef.reset_devices(2)
+    core = pf.PongoCore(rom, ef.build_bus())
+    log = ef.InputLog(2)
+    assert ef.run_frames(core, frames=30, exchange=MovingViewer(core), record=log) == 30
+    assert len(log) == 30
+    assert any(log.changes(frame) for frame in range(len(log)))
+
+    ef.reset_devices(log.seed)
+    core = pf.PongoCore(rom, ef.build_bus())
+    assert ef.run_frames(core, frames=len(log), replay=log) == 30
+    assert log.diverged is None
@@ -0,0 +1,157 @@
+import os
+import random
+
+import pytest
+
+import emufour as ef
+import pongofour as pf
+import proffour
+import tracefour
+import testroms
+
+# Jumps into the registers, so the next fetch comes from Nand. With Indi at 0 that reads back as -1.
+def nand_core(a, pushes):
+    core = pf.PongoCore(bytes(16))
+    core.ram[pf.Regs.IpLo] = pf.Regs.Nand
+    core.ram[pf.Regs.IpHi] = 0
+    core.a = a
+    core.num_pushes = pushes
+    return core
+
+def test_nand_fetch_does_nothing():
+    core = nand_core(0x1234, 1)
+    core.spin()
+    assert core.a == 0x1234
+    assert core.d == 0
+    assert core.num_pushes == 0
+    assert core.ram[pf.Regs.IpLo] == pf.Regs.Flow
+
+def test_nand_fetch_through_run_until():
+    core = nand_core(0x1234, 2)
+    core.run_until(1)
+    assert (core.a, core.num_pushes, core.cycles) == (0x1234, 0, 1)
+
+def test_nand_fetch_after_too_many_pushes():
+    core = nand_core(0x1234, 3)
+    with pytest.raises(RuntimeWarning):
+        core.spin()
+
+ROM = os.path.join(os.path.dirname(__file__), "..", "pfpong.bin")
+
+def pfpong_core():
+    ef.reset_devices(1)
+    return pf.PongoCore(ef.load_rom(ROM), ef.build_bus())
+
+# Where pfpong's IP is after the given number of instructions.
+def ip_after(cycles):
+    core = pfpong_core()
+    for i in range(cycles): core.spin()
+    return core.ram[pf.Regs.IpLo] | core.ram[pf.Regs.IpHi] << 8
+
+# A watch that's been taken away mustn't leave its hit behind for the next run to report.
+def test_hit_cleared_by_next_run():
+    core = pfpong_core()
+    core.add_watchpoint(0xB)
+    core.run_until(100000)
+    assert core.hit == ("write", 0xB, core.ram[0xB])
+    core.remove_watchpoint(0xB)
+    core.run_until(core.cycles + 1000)
+    assert core.hit is None
+    core.hit = ("read", 0)
+    core.spin()
+    assert core.hit is None
+
+@pytest.mark.parametrize("make_runner", [lambda: None, tracefour.TraceRecorder, proffour.Profiler])
+def test_runners_stop_at_breakpoints(make_runner):
+    runner = make_runner()
+    core = pfpong_core()
+    run_until = core.run_until if runner is None else lambda cycles: runner.run_until(core, cycles)
+    target = ip_after(5000)
+    core.add_breakpoint(target)
+    run_until(100000)
+    assert core.hit == ("break", target)
+    stopped = core.cycles
+
+    # Carrying on lets it go once, then it's hit again.
+    run_until(100000000)
+    assert core.hit == ("break", target)
+    assert core.cycles > stopped
+
+    core.add_watchpoint(0xC)
+    run_until(core.cycles + 100000)
+    assert core.hit[:2] == ("write", 0xC)
+
+def test_breakpoint_conditions():
+    core = nand_core(0, 0)
+    core.ram[pf.Regs.LoopLo] = 2
+    assert pf.compile_condition("loop < 3 and ram[2] == 2")(core)
+    assert not pf.compile_condition("(a >> 6) + d * 2 != 0")(core)
+    assert pf.compile_condition("ram[0x10000] == 0")(core)
+    for bad in ("lop < 3", "__import__('os').getpid() > 0", "ram.__class__", "[x for x in ram]", "'a' < 'b'", "1 <<"):
+        with pytest.raises(ValueError):
+            pf.compile_condition(bad)
+
+
+# Everything the guest could tell apart, including the devices.
+def state(core):
+    return (bytes(core.ram_view), core.a, core.d, core.num_pushes, core.flow_state(), core.cycles, core.io_handler.get_state())
+
+# Both return whether the core faulted on the way.
+def spin_to(core, cycles):
+    try:
+        while core.cycles < cycles: core.spin()
+    except RuntimeWarning:
+        return True
+    return False
+
+def run_to(core, cycles):
+    try:
+        core.run_until(cycles)
+    except RuntimeWarning:
+        return True
+    return False
+
+# Runs a ROM on two cores, one an instruction at a time and the other through run_until() in
+# random-sized pieces, checking they agree after every piece.
+def check_against_spin(rom, cycles, seed=0, inputs=(0, 0, 0, 0), longest=5000):
+    stepped = pf.PongoCore(rom, testroms.device_bus(seed, inputs))
+    run = pf.PongoCore(rom, testroms.device_bus(seed, inputs))
+    rng = random.Random(seed)
+    while stepped.cycles < cycles:
+        target = min(cycles, stepped.cycles + rng.randint(1, longest))
+        faulted = spin_to(stepped, target)
+        assert run_to(run, target) == faulted
+        assert state(run) == state(stepped), f"differs at cycle {stepped.cycles}"
+        if faulted: return
+
+# A push on the store to Ip at the bottom of a loop changes A, so the loop can't be done in one go.
+def test_loop_with_pushed_jump():
+    asm = testroms.Assembler()
+    asm.memset(0x100, 50, 0x5A)
+    asm.code.insert(len(asm.code) - 1, pf.Opcodes.PushA << 6)
+    asm.halt()
+    check_against_spin(asm.rom(), 1500, longest=50)
+
+# run_until() has to end up exactly where spin() does, however it's sliced up.
+def test_run_until_matches_spin_on_pfpong():
+    check_against_spin(ef.load_rom(ROM), 1000000, seed=1, inputs=(5, 1, 7, 0))
+
+# Random bytes make for every mix of pushes, flow flags and faults.
+def test_run_until_matches_spin_on_random_roms():
+    for seed in range(300):
+        check_against_spin(testroms.random_rom(seed), 3000, seed, longest=500)
+
+def idioms_in(rom):
+    return {pf.LoopIdiom.match(rom, 0x8000 + i).kind for i in range(len(rom)) if pf.LoopIdiom.match(rom, 0x8000 + i)}
+
+# The loops done in one go have to leave memory, devices, Loop, Indi and the Tmps just as going
+# round them would, including when they're cut short partway.
+def test_idioms_match_spin():
+    rom = testroms.idiom_rom()
+    assert idioms_in(rom) == {"memcpy", "memset", "idle"}
+    check_against_spin(rom, 400000, longest=20000)
+
+@pytest.mark.parametrize("rom", testroms.wraparound_roms())
+def test_idioms_with_loop_at_zero(rom):
+    assert idioms_in(rom)
+    check_against_spin(rom, 2000000, longest=100000)
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import emufour as ef
+import pongofour as pf
+import testroms
+import vecfour
+
+ROM = os.path.join(os.path.dirname(__file__), "..", "pfpong.bin")
+
+def scalar_state(core):
+    return (bytes(core.ram_view), core.a, core.d, core.num_pushes, core.flow_state(), core.cycles)
+
+def batch_state(batch, index):
+    flags = (int(batch.next_sixteen[index]) | int(batch.next_inhibit[index]) << 1 |
+             int(batch.next_load_indirect[index]) << 2 | int(batch.next_store_indirect[index]) << 3)
+    return (batch.ram[index].tobytes(), int(batch.a[index]), int(batch.d[index]),
+            int(batch.num_pushes[index]), flags, int(batch.cycles[index]))
+
+# Steps a batch alongside a scalar core per instance, with the same devices and input, and checks
+# every instance against its core now and then. A core that faults stops, same as its instance should.
+def check_against_spin(rom, seeds, steps, inputs=lambda index: (0, 0, 0, 0), every=97):
+    cores = [pf.PongoCore(rom, testroms.device_bus(seed, inputs(index))) for index, seed in enumerate(seeds)]
+    faulted = [False] * len(cores)
+    devices = vecfour.BatchDevices(len(seeds), seeds)
+    for index in range(len(seeds)): devices.controllers[index] = inputs(index)
+    batch = vecfour.PongoCoreBatch(rom, len(seeds), devices.read, devices.write)
+
+    for step in range(steps):
+        for index, core in enumerate(cores):
+            if faulted[index]: continue
+            try:
+                core.spin()
+            except RuntimeWarning:
+                faulted[index] = True
+        batch.step()
+
+        if step % every == 0 or step == steps - 1:
+            for index, core in enumerate(cores):
+                assert bool(batch.faulted[index]) == faulted[index], f"instance {index} at step {step}"
+                assert batch_state(batch, index) == scalar_state(core), f"instance {index} at step {step}"
+                assert devices.vram[index].tobytes() == core.io_handler.get_state()[0], f"instance {index} at step {step}"
+
+def test_batch_matches_spin_on_pfpong():
+    check_against_spin(ef.load_rom(ROM), range(8), 20000, lambda index: (index * 3 % 32, index & 1, index, 0))
+
+def test_batch_matches_spin_on_idioms():
+    check_against_spin(testroms.idiom_rom(), range(2), 20000)
+
+def test_batch_matches_spin_on_random_roms():
+    for seed in range(60):
+        check_against_spin(testroms.random_rom(seed), range(seed * 4, seed * 4 + 4), 1000, every=1)
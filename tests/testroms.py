@@ -0,0 +1,118 @@
+import random
+
+import emufour as ef
+import pongofour as pf
+
+# Just enough of environment.lisp's encoding to build small test ROMs from Python.
+
+# The pushes and final six bits a value takes, shortest first, the way the assembler picks them.
+def chunks(value):
+    value &= 0xFFFF
+    top, middle, bottom = value >> 12, (value >> 6) & 0x3F, value & 0x3F
+    if value & 0x8000:
+        if top == 0xF and middle == 0x3F and bottom & 0x20: return [bottom]
+        if top == 0xF and middle == 0x3F: return [0x3F, bottom]
+        if top == 0xF and middle & 0x20: return [middle, bottom]
+        return [middle, top, bottom]
+    if top == 0 and middle == 0 and not bottom & 0x20: return [bottom]
+    if top == 0 and middle == 0: return [0, bottom]
+    if top == 0 and not middle & 0x20: return [middle, bottom]
+    return [middle, top, bottom]
+
+def inst(opcode, value):
+    parts = chunks(value)
+    return [pf.Opcodes.PushA << 6 | part for part in parts[:-1]] + [opcode << 6 | parts[-1]]
+
+class Assembler():
+    def __init__(self):
+        self.code = []
+
+    def here(self):
+        return 0x8000 + len(self.code)
+
+    def flow(self, flags):
+        self.code += inst(pf.Opcodes.AMovD, flags) + inst(pf.Opcodes.DmovAs, pf.Regs.Flow)
+
+    # Copies a value (or, with pointer, what's at that address) to dest.
+    def move(self, value, dest, pointer=False, wide=False, load_indirect=False, store_indirect=False, inhibit=False):
+        flags = (pf.FlowLines.SixteenWide if wide else 0) | (pf.FlowLines.InhibitIfZero if inhibit else 0)
+        flags |= (pf.FlowLines.LoadIndirect if load_indirect else 0) | (pf.FlowLines.StoreIndirect if store_indirect else 0)
+        if flags: self.flow(flags)
+        self.code += inst(pf.Opcodes.AsMovD if pointer else pf.Opcodes.AMovD, value) + inst(pf.Opcodes.DmovAs, dest)
+
+    def loop_for(self, count, body):
+        self.move(count, pf.Regs.LoopLo, wide=True)
+        top = self.here()
+        body()
+        self.flow(pf.FlowLines.LoopDown)
+        self.move(top, pf.Regs.IpLo, wide=True, inhibit=True)
+
+    def memset(self, dest, count, value, pointer=False):
+        self.move(dest, pf.Regs.IndiLo, wide=True)
+        self.loop_for(count, lambda: (self.move(value, pf.Regs.IndiLo, pointer, store_indirect=True),
+                                      self.flow(pf.FlowLines.IndirectUp)))
+
+    # Like the environment's memcpy, which goes from TmpD to TmpB.
+    def memcpy(self, src, dest, count):
+        self.move(dest, 0xC, wide=True)
+        self.move(src, 0xE, wide=True)
+        def body():
+            self.move(0xE, pf.Regs.IndiLo, True, wide=True)
+            self.move(pf.Regs.IndiLo, 0xB, True, load_indirect=True)
+            self.flow(pf.FlowLines.IndirectUp)
+            self.move(pf.Regs.IndiLo, 0xE, True, wide=True)
+            self.move(0xC, pf.Regs.IndiLo, True, wide=True)
+            self.move(0xB, pf.Regs.IndiLo, True, store_indirect=True)
+            self.flow(pf.FlowLines.IndirectUp)
+            self.move(pf.Regs.IndiLo, 0xC, True, wide=True)
+        self.loop_for(count, body)
+
+    def wait_frame(self):
+        self.code += inst(pf.Opcodes.AMovD, 1) + inst(pf.Opcodes.DmovAs, 0x4407)
+
+    def halt(self):
+        self.move(self.here(), pf.Regs.IpLo, wide=True)
+
+    def rom(self):
+        return bytes(self.code)
+
+# The same devices build_bus() hangs off a core, but a set of its own, so two cores can run side by side.
+def device_bus(seed=0, inputs=(0, 0, 0, 0)):
+    bus = pf.DeviceBus()
+    bus.attach(ef.Display(), 0, 1024)
+    bus.attach(ef.Controllers(), 1024, 4).set_state(inputs)
+    bus.attach(ef.Rng(seed), 1028)
+    bus.attach(ef.EmuFlow(), 1031)
+    return bus
+
+# Every kind of loop the idioms take on: RAM, VRAM and I/O on either end, ROM sources, overlapping
+# copies both ways, and some flow soup at the end.
+def idiom_rom():
+    asm = Assembler()
+    for i in range(2):
+        asm.memset(0x100, 300, 0x5A + i)
+        asm.memset(0x4000, 1024, 0x4404, pointer=True)
+        asm.memset(0x4000, 1024, 7 + i)
+        asm.memset(0x300, 50, 0x120, pointer=True)
+        asm.memcpy(0x4000, 0x100, 700)
+        asm.memcpy(0x8000, 0x2000, 2000)
+        asm.memcpy(0x2000, 0x4000, 500)
+        asm.memcpy(0x100, 0x101, 100)
+        asm.memcpy(0x181, 0x180, 100)
+        asm.wait_frame()
+    for flags in (0x40, 0x44, 0x4C, 0x0C, 0x48, 0x04):
+        for i in range(40): asm.flow(flags)
+    asm.halt()
+    return asm.rom()
+
+# A Loop count of 0 goes round 65536 times, which runs off the end of I/O into ROM.
+def wraparound_roms():
+    copy = Assembler()
+    copy.memcpy(0x2000, 0x3000, 0)
+    fill = Assembler()
+    fill.memset(0x10, 0, 0x77)
+    return [copy.rom(), fill.rom()]
+
+def random_rom(seed):
+    rng = random.Random(seed)
+    return bytes(rng.randrange(256) for i in range(rng.choice((64, 512, 4096))))
@@ -0,0 +1,113 @@
+import sys
+import struct
+import argparse
+
+# Binary execution traces. Recording packs the state before each instruction into a fixed-size
+# record, which is cheap enough to leave on for millions of instructions; turning records back
+# into text (and loading the assembler to do it) happens afterwards, with:
+#   python tracefour.py trace.bin
+
+# Ip, A, D, Loop, Indi, pending flags, the instruction byte, then Add and TmpA-TmpE.
+# The flags byte is flow_state() in the low nibble and the push count above it.
+RECORD = struct.Struct("<HHHHHBB6s")
+MAGIC = b"PONGOTR1"
+
+class TraceRecorder():
+    def __init__(self, path=None, records=65536):
+        self.size = RECORD.size
+        self.records = records
+        self.buffer = bytearray(self.size * records)
+        self.pos = 0
+        self.total = 0
+        self.wrapped = False
+
+        # With a file, the buffer gets written out every time it fills. Without one it's a ring
+        # that keeps the last few instructions around for save().
+        self.file = None
+        if path is not None:
+            self.file = open(path, "wb", buffering=1 << 20)
+            self.file.write(MAGIC)
+
+    def record(self, core):
+        memory = core.memory
+        ip = memory[0] | memory[1] << 8
+        RECORD.pack_into(self.buffer, self.pos * self.size, ip, core.a, core.d,
+                         memory[2] | memory[3] << 8, memory[4] | memory[5] << 8,
+                         core.flow_state() | core.num_pushes << 4, memory[ip], bytes(memory[0xA:0x10]))
+
+        self.pos += 1
+        self.total += 1
+        if self.pos == self.records:
+            if self.file is not None: self.flush()
+            else:
+                self.pos = 0
+                self.wrapped = True
+
+    def flush(self):
+        if self.file is not None:
+            self.file.write(memoryview(self.buffer)[:self.pos * self.size])
+            self.pos = 0
+
+    # Like PongoCore.run_until, but one instruction at a time so each one gets a record. Stops at
+    # breakpoints and watches the same way.
+    def run_until(self, core, cycles, stop=None):
+        resume_ip = core.resume_from_hit()
+        memory = core.memory
+        while core.cycles < cycles and not (stop is not None and stop()):
+            ip = memory[0] | memory[1] << 8
+            if core.breakpoints and ip != resume_ip and core.at_breakpoint(ip): break
+            resume_ip = None
+            self.record(core)
+            core.spin()
+            if core.hit is not None: break
+
+    # Write out what's in the ring, oldest first.
+    def save(self, path):
+        with open(path, "wb") as outfile:
+            outfile.write(MAGIC)
+            if self.wrapped: outfile.write(memoryview(self.buffer)[self.pos * self.size:])
+            outfile.write(memoryview(self.buffer)[:self.pos * self.size])
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def read_trace(path):
+    with open(path, "rb") as infile:
+        if infile.read(len(MAGIC)) != MAGIC: raise ValueError(f"{path} isn't a trace")
+        while True:
+            chunk = infile.read(RECORD.size * 4096)
+            if not chunk: break
+            yield from RECORD.iter_unpack(chunk[:len(chunk) - len(chunk) % RECORD.size])
+
+# The same view emufour's print_state gives.
+def format_record(record, disassemble):
+    ip, a, d, loop, indi, flags, inst, temps = record
+    pending = f"{'W' if flags & 1 else ' '}{'I' if flags & 2 else ' '}{'L' if flags & 4 else ' '}{'S' if flags & 8 else ' '}"
+    return f"Ip ${ip:04x}, A ${a:04x}, D ${d:04x} | Loop ${loop:04x}, Indi ${indi:04x} {pending} | {temps[1]:02x} {temps[2]:02x} {temps[3]:02x} {temps[4]:02x} {temps[5]:02x}   |   {disassemble(inst)}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pongo v4 trace decoder")
+    parser.add_argument("trace", help="trace file from emufour --trace")
+    parser.add_argument("--skip", type=int, default=0, help="skip this many records first")
+    parser.add_argument("--count", type=int, help="stop after this many records")
+    args = parser.parse_args()
+
+    import asmfour as af
+
+    # Most of a trace is the same few instructions over and over.
+    disassembly = [str(af.RawInstruction.disassemble(inst)) for inst in range(256)]
+
+    shown = 0
+    for index, record in enumerate(read_trace(args.trace)):
+        if index < args.skip: continue
+        if args.count is not None and shown >= args.count: break
+        try:
+            print(format_record(record, disassembly.__getitem__))
+        except BrokenPipeError:
+            sys.exit(0)
+        shown += 1
@@ -0,0 +1,328 @@
+import random
+
+import numpy as np
+
+import pongofour as pf
+
+# Lots of Pongo v4 cores stepped in lockstep with numpy, for fuzzing and the like. Every instance has
+# its own RAM, registers and IP, and all of them run from the same ROM. One step() runs one instruction on
+# every active instance, and does exactly what PongoCore.spin() would have done to each of them.
+#
+# Where spin() would raise (too many pushes in a row, writing to ROM), the instance is marked faulted
+# instead and stops being stepped. Its state is left however far spin() would have got before raising.
+#
+# I/O goes through two functions taking arrays: io_read(rows, offsets) returns a byte for each, and
+# io_write(rows, offsets, values) does the writes. Offsets are from the start of the I/O window, like
+# the scalar DeviceBus. Without them, I/O reads $EA and ignores writes, like an empty bus.
+
+class PongoCoreBatch():
+    def __init__(self, rom, count, io_read=None, io_write=None):
+        self.count = count
+        self.io_read = io_read
+        self.io_write = io_write
+
+        # ROM padded out to the whole top half, which is what the scalar core sees past the end of it.
+        scalar = pf.PongoCore(rom)
+        self.rom_length = len(scalar.rom)
+        self.rom = np.zeros(0x8000, dtype=np.int64)
+        self.rom[:self.rom_length] = np.frombuffer(bytes(scalar.rom), dtype=np.uint8)
+
+        # spin() takes the final A from predecoding when the push count matches. That's the same answer as
+        # working it out from A unless A's low bits were messed with, but bit-identical means bit-identical.
+        self.static_pushes = np.full(0x8000, -1, dtype=np.int64)
+        self.static_a = np.zeros(0x8000, dtype=np.int64)
+        for index, (opcode, data, handler, static_pushes, static_a) in enumerate(scalar.decoded):
+            if static_pushes is not None and static_pushes >= 0:
+                self.static_pushes[index] = static_pushes
+                self.static_a[index] = static_a
+
+        self.ram = np.zeros((count, 0x4000), dtype=np.uint8)
+        self.a = np.zeros(count, dtype=np.int64)
+        self.d = np.zeros(count, dtype=np.int64)
+        self.num_pushes = np.zeros(count, dtype=np.int64)
+        self.next_sixteen = np.zeros(count, dtype=bool)
+        self.next_inhibit = np.zeros(count, dtype=bool)
+        self.next_load_indirect = np.zeros(count, dtype=bool)
+        self.next_store_indirect = np.zeros(count, dtype=bool)
+        self.cycles = np.zeros(count, dtype=np.int64)
+
+        # Only active instances get stepped; faulted ones never do again.
+        self.active = np.ones(count, dtype=bool)
+        self.faulted = np.zeros(count, dtype=bool)
+        self.reset()
+
+    def reset(self):
+        self.ram[:] = 0
+        self.ram[:, pf.Regs.IpHi] = 0x80
+        for vector in (self.a, self.d, self.num_pushes, self.cycles): vector[:] = 0
+        for flag in (self.next_sixteen, self.next_inhibit, self.next_load_indirect, self.next_store_indirect, self.faulted):
+            flag[:] = False
+
+    # Moving single instances to and from a scalar core, e.g. to take a closer look at one.
+    def copy_to(self, index, core):
+        core.ram_view[:] = self.ram[index].tobytes()
+        core.a = int(self.a[index])
+        core.d = int(self.d[index])
+        core.num_pushes = int(self.num_pushes[index])
+        core.next_sixteen = bool(self.next_sixteen[index])
+        core.next_inhibit = bool(self.next_inhibit[index])
+        core.next_load_indirect = bool(self.next_load_indirect[index])
+        core.next_store_indirect = bool(self.next_store_indirect[index])
+        core.cycles = int(self.cycles[index])
+
+    def copy_from(self, index, core):
+        self.ram[index] = np.frombuffer(bytes(core.ram_view), dtype=np.uint8)
+        self.a[index] = core.a
+        self.d[index] = core.d
+        self.num_pushes[index] = core.num_pushes
+        self.next_sixteen[index] = core.next_sixteen
+        self.next_inhibit[index] = core.next_inhibit
+        self.next_load_indirect[index] = core.next_load_indirect
+        self.next_store_indirect[index] = core.next_store_indirect
+        self.cycles[index] = core.cycles
+
+    # PongoCore.get() for one address per row. Can come back negative, same as reading Nand does there.
+    def read(self, rows, addrs):
+        ram = self.ram
+        values = np.empty(len(rows), dtype=np.int64)
+
+        plain = addrs < 0x4000
+        values[plain] = ram[rows[plain], addrs[plain]]
+
+        nand = addrs == pf.Regs.Nand
+        if nand.any():
+            r = rows[nand]
+            values[nand] = ~(ram[r, pf.Regs.IndiLo].astype(np.int64) & ram[r, pf.Regs.IndiHi])
+        flow = addrs == pf.Regs.Flow
+        if flow.any():
+            low = ram[rows[flow], pf.Regs.IndiLo].astype(np.int64)
+            values[flow] = (low >> 1) | ((low & 1) << 7)
+
+        io = (addrs >= 0x4000) & (addrs < 0x8000)
+        if io.any():
+            if self.io_read is None: values[io] = 0xEA
+            else: values[io] = np.asarray(self.io_read(rows[io], addrs[io] - 0x4000), dtype=np.int64) & 0xFF
+
+        high = addrs >= 0x8000
+        values[high] = self.rom[addrs[high] - 0x8000]
+        return values
+
+    # PongoCore.set() for one address per row, with values already cut down to a byte. Returns which ones
+    # tried to write to ROM.
+    def write(self, rows, addrs, values):
+        plain = addrs < 0x4000
+        self.ram[rows[plain], addrs[plain]] = values[plain]
+
+        flow = addrs == pf.Regs.Flow
+        if flow.any(): self.flow_write(rows[flow], values[flow])
+
+        io = (addrs >= 0x4000) & (addrs < 0x8000)
+        if io.any() and self.io_write is not None: self.io_write(rows[io], addrs[io] - 0x4000, values[io])
+
+        return addrs >= 0x8000
+
+    # Same as FLOW_ACTIONS: latch the flags, then loop down, indirect up, indirect down.
+    def flow_write(self, rows, values):
+        self.next_sixteen[rows[(values & pf.FlowLines.SixteenWide) != 0]] = True
+        self.next_inhibit[rows[(values & pf.FlowLines.InhibitIfZero) != 0]] = True
+        self.next_load_indirect[rows[(values & pf.FlowLines.LoadIndirect) != 0]] = True
+        self.next_store_indirect[rows[(values & pf.FlowLines.StoreIndirect) != 0]] = True
+
+        for line, base, step in ((pf.FlowLines.LoopDown, pf.Regs.LoopLo, -1), (pf.FlowLines.IndirectUp, pf.Regs.IndiLo, 1),
+                                 (pf.FlowLines.IndirectDown, pf.Regs.IndiLo, -1)):
+            r = rows[(values & line) != 0]
+            if len(r): self.counter_step(r, base, step)
+
+    def counter_step(self, rows, base, step):
+        value = (self.ram[rows, base].astype(np.int64) | self.ram[rows, base + 1].astype(np.int64) << 8) + step
+        self.ram[rows, base] = value & 0xFF
+        self.ram[rows, base + 1] = (value >> 8) & 0xFF
+
+    # a_effective() for arrays.
+    def final_a(self, a, pushes, data):
+        six_bits = (a | data) & 0x3F
+        twelve_bits = (a | data) & 0xFFF
+        return np.where(pushes == 0, np.where(six_bits & 0x20, six_bits | 0xFFC0, six_bits),
+                        np.where(pushes == 1, np.where(twelve_bits & 0x800, twelve_bits | 0xF000, twelve_bits), (a | data) & 0xFFFF))
+
+    # One instruction on every active instance.
+    def step(self):
+        rows = np.flatnonzero(self.active & ~self.faulted)
+        if not len(rows): return
+        ram = self.ram
+
+        this_ip = ram[rows, pf.Regs.IpHi].astype(np.int64) << 8 | ram[rows, pf.Regs.IpLo]
+        inst = self.read(rows, this_ip)
+
+        next_ip = (this_ip + 1) & 0xFFFF
+        ram[rows, pf.Regs.IpLo] = next_ip & 0xFF
+        ram[rows, pf.Regs.IpHi] = next_ip >> 8
+        self.cycles[rows] += 1
+
+        # Negative reads (from Nand) don't decode to anything; they get -1 here and fall through every
+        # opcode below, apart from the push check and clearing the pushes. Same as spin().
+        opcode = np.where(inst < 0, -1, inst >> 6)
+        data = inst & 0x3F
+
+        # Pushes.
+        push = opcode == pf.Opcodes.PushA
+        if push.any():
+            r = rows[push]
+            pushed = data[push]
+            side = self.num_pushes[r] & 1
+            chunk = np.where(side == 0, pushed << 6, (pushed << 12) & 0xFFFF)
+            self.a[r] = (self.a[r] & np.where(side == 0, pf.PUSH_KEEP[0], pf.PUSH_KEEP[1])) | chunk
+            self.num_pushes[r] += 1
+
+        # Everything else needs the final A.
+        rest = ~push
+        if not rest.any(): return
+        rows = rows[rest]
+        this_ip = this_ip[rest]
+        opcode = opcode[rest]
+        data = data[rest]
+        pushes = self.num_pushes[rows]
+
+        too_many = pushes > 2
+        if too_many.any():
+            self.faulted[rows[too_many]] = True
+            ok = ~too_many
+            rows, this_ip, opcode, data, pushes = rows[ok], this_ip[ok], opcode[ok], data[ok], pushes[ok]
+
+        final = self.final_a(self.a[rows], pushes, data)
+
+        nothing = opcode == -1
+        if nothing.any(): self.num_pushes[rows[nothing]] = 0
+
+        in_rom = (this_ip >= 0x8000) & (this_ip < 0x8000 + self.rom_length)
+        rom_index = np.where(in_rom, this_ip - 0x8000, 0)
+        static = in_rom & (self.static_pushes[rom_index] == pushes)
+        final = np.where(static, self.static_a[rom_index], final)
+
+        # a>d
+        amovd = opcode == pf.Opcodes.AMovD
+        if amovd.any():
+            r = rows[amovd]
+            self.d[r] = final[amovd]
+            self.num_pushes[r] = 0
+
+        # a*>d
+        asmovd = opcode == pf.Opcodes.AsMovD
+        if asmovd.any():
+            r = rows[asmovd]
+            addr = final[asmovd]
+            do_six = self.next_sixteen[r]
+
+            load = self.next_load_indirect[r]
+            if load.any():
+                lr = r[load]
+                addr[load] = ram[lr, pf.Regs.IndiHi].astype(np.int64) << 8 | ram[lr, pf.Regs.IndiLo]
+                self.next_load_indirect[lr] = False
+
+            new_data = self.read(r, addr & 0xFFFF)
+            if do_six.any():
+                new_data[do_six] = self.read(r[do_six], (addr[do_six] + 1) & 0xFFFF) << 8 | new_data[do_six]
+
+            self.d[r] = new_data & 0xFFFF
+            self.num_pushes[r] = 0
+
+        # d>a*
+        dmovas = opcode == pf.Opcodes.DmovAs
+        if dmovas.any():
+            r = rows[dmovas]
+            addr = final[dmovas]
+            do_six = self.next_sixteen[r].copy()
+            move = np.ones(len(r), dtype=bool)
+
+            inhibit = self.next_inhibit[r]
+            if inhibit.any():
+                loop = ram[r, pf.Regs.LoopHi].astype(np.int64) << 8 | ram[r, pf.Regs.LoopLo]
+                move &= ~(inhibit & (loop == 0))
+                self.next_inhibit[r[inhibit]] = False
+
+            store = self.next_store_indirect[r] & move
+            if store.any():
+                sr = r[store]
+                addr[store] = ram[sr, pf.Regs.IndiHi].astype(np.int64) << 8 | ram[sr, pf.Regs.IndiLo]
+                self.next_store_indirect[sr] = False
+
+            d = self.d[r]
+            failed = np.zeros(len(r), dtype=bool)
+            failed[move] = self.write(r[move], addr[move] & 0xFFFF, d[move] & 0xFF)
+
+            wide = move & do_six & ~failed
+            if wide.any():
+                failed[wide] = self.write(r[wide], (addr[wide] + 1) & 0xFFFF, (d[wide] >> 8) & 0xFF)
+
+            self.faulted[r[failed]] = True
+            self.next_sixteen[r[do_six & ~failed]] = False
+            self.num_pushes[r[~failed]] = 0
+
+    def run(self, steps):
+        for i in range(steps): self.step()
+
+
+# The emulator's devices (see emufour), one set per instance, to pass to PongoCoreBatch as its I/O.
+class BatchDevices():
+    def __init__(self, count, seeds):
+        self.vram = np.zeros((count, 1024), dtype=np.uint8)
+        self.controllers = np.zeros((count, 4), dtype=np.uint8)
+        self.waiting_frame = np.zeros(count, dtype=bool)
+        self.pause_requested = np.zeros(count, dtype=bool)
+
+        # Same generator and block size as emufour's Rng, so the numbers come out the same for the same seed.
+        self.generators = [random.Random(seed) for seed in seeds]
+        self.random = np.zeros((count, 4096), dtype=np.uint8)
+        self.random_index = np.full(count, 4096, dtype=np.int64)
+
+    def read(self, rows, offsets):
+        values = np.full(len(rows), 0xEA, dtype=np.int64)
+
+        pads = (offsets >= 1024) & (offsets < 1028)
+        values[pads] = self.controllers[rows[pads], offsets[pads] - 1024]
+
+        rand = offsets == 1028
+        if rand.any():
+            r = rows[rand]
+            for row in r[self.random_index[r] >= 4096]:
+                self.random[row] = np.frombuffer(self.generators[row].randbytes(4096), dtype=np.uint8)
+                self.random_index[row] = 0
+            values[rand] = self.random[r, self.random_index[r]]
+            self.random_index[r] += 1
+
+        return values
+
+    def write(self, rows, offsets, values):
+        screen = offsets < 1024
+        self.vram[rows[screen], offsets[screen]] = values[screen]
+
+        flow = offsets == 1031
+        if flow.any():
+            r = rows[flow]
+            v = values[flow]
+            self.waiting_frame[r[(v & 0x81) != 0]] = True
+            self.pause_requested[r[(v & 0x80) != 0]] = True
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    import emufour as ef
+
+    parser = argparse.ArgumentParser(description="Pongo v4 lockstep batch")
+    parser.add_argument("rom", help="binary to run (from impede)")
+    parser.add_argument("--count", type=int, default=1024, help="instances to run (default: 1024)")
+    parser.add_argument("--steps", type=int, default=10000, help="instructions to run on each (default: 10000)")
+    parser.add_argument("--seed", type=int, default=0, help="first instance's seed; the rest count up from it")
+    args = parser.parse_args()
+
+    devices = BatchDevices(args.count, range(args.seed, args.seed + args.count))
+    batch = PongoCoreBatch(bytes(ef.load_rom(args.rom)), args.count, devices.read, devices.write)
+
+    begin_time = time.perf_counter()
+    batch.run(args.steps)
+    total_time = time.perf_counter() - begin_time
+
+    instructions = int(batch.cycles.sum())
+    print(f"Ran {instructions} instructions over {args.count} instances in {total_time:.2f}s ({instructions / total_time / 1000000:.2f} MIPS), "
+          f"{int(batch.faulted.sum())} faulted, {len({row.tobytes() for row in devices.vram})} different framebuffers")